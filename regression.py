@@ -0,0 +1,629 @@
+"""批量生成工具的回归测试与基准测试
+
+用法:
+    python regression.py --regression [字体路径] [差异图目录]
+    python regression.py --benchmark-composite [字体路径]
+    python regression.py --benchmark-text 字体路径
+"""
+from PIL import Image, ImageChops, ImageDraw, ImageFont
+from psd_tools import PSDImage
+from psd_tools.api.layers import PixelLayer
+import os
+import io
+import csv
+import math
+import time
+import sys
+import platform
+import tempfile
+import multiprocessing
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from tool import (ArchiveShardSink, GlyphAtlas, QuietLog, SharedTemplate, compile_template, composite_layer,
+                  create_process_executor, encode_image, flatten_to_rgb, get_font_filename_map, list_available_fonts,
+                  render_psd_row, render_row_in_worker, render_text_with_wrapping, verify_shard_index)
+
+
+def benchmark_text_backends(font_path, texts=None, font_size=32, rect_size=(480, 120), repeats=20, tolerance=64,
+                            max_mismatch_ratio=0.001):
+    """对比 draw.text 与字形缓存两种文本渲染方式的耗时和像素差异"""
+    if texts is None:
+        texts = ["¥19.90", "¥1,299.00", "特价 ¥8.8", "苹果 Apple", "新品上市", "0123456789", "限时折扣 75%"]
+    font = ImageFont.truetype(font_path, font_size)
+    glyph_atlas = GlyphAtlas()
+    rect = (0, 0) + tuple(rect_size)
+
+    def render_all(atlas):
+        images = []
+        for text in texts:
+            image = Image.new("RGBA", rect_size, (255, 255, 255, 0))
+            render_text_with_wrapping(ImageDraw.Draw(image), text, rect, font, (0, 0, 0, 255), "center", "center",
+                                      "fixed", glyph_atlas=atlas)
+            images.append(image)
+        return images
+
+    reference_images = render_all(None)
+    atlas_images = render_all(glyph_atlas)
+
+    max_diff = 0
+    mismatched = 0
+    total = 0
+    for reference, candidate in zip(reference_images, atlas_images):
+        diff = np.abs(np.asarray(reference, dtype=np.int16) - np.asarray(candidate, dtype=np.int16))
+        max_diff = max(max_diff, int(diff.max()))
+        mismatched += int(np.count_nonzero(diff.max(axis=2) > tolerance))
+        total += diff.shape[0] * diff.shape[1]
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        render_all(None)
+    pillow_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(repeats):
+        render_all(glyph_atlas)
+    atlas_seconds = time.perf_counter() - start
+
+    mismatch_ratio = mismatched / total if total else 0.0
+    return {
+        "pillow_seconds": pillow_seconds,
+        "atlas_seconds": atlas_seconds,
+        "speedup": pillow_seconds / atlas_seconds if atlas_seconds else float("inf"),
+        "max_diff": max_diff,
+        "mismatch_ratio": mismatch_ratio,
+        "within_tolerance": mismatch_ratio <= max_mismatch_ratio
+    }
+
+
+def reference_load_font(layer_name, layer_info, font_mapping, color_mapping, font_size_mapping):
+    """优化前逐行内联的字体、颜色查找, 原样保留作为回归测试的基准; 返回 (font, text_color)"""
+    font_size = 12
+    text_color = (0, 0, 0, 255)
+    font_name = None
+
+    if layer_info:
+        if layer_name in color_mapping:
+            text_color = color_mapping[layer_name]
+        elif layer_info['color']:
+            text_color = layer_info['color']
+        if layer_name in font_size_mapping:
+            font_size = font_size_mapping[layer_name]
+        elif layer_info['font_size']:
+            font_size = int(layer_info['font_size'])
+        if layer_info['font']:
+            font_name = layer_info['font']
+            if isinstance(font_name, dict) and 'Name' in font_name:
+                font_name = font_name['Name']
+
+    font = None
+    font_loaded = False
+
+    if layer_name in font_mapping:
+        font_path = font_mapping[layer_name]
+        if os.path.exists(font_path) and font_path != "保持原始字体":
+            try:
+                font = ImageFont.truetype(font_path, font_size)
+                font_loaded = True
+            except Exception as e:
+                pass
+    if not font_loaded and isinstance(font_name, str):
+        font_filename_map = get_font_filename_map()
+        font_name_lower = font_name.lower().replace(" ", "")
+        mapped_font = None
+        for key, value in font_filename_map.items():
+            key_lower = key.lower().replace(" ", "")
+            if key_lower in font_name_lower or font_name_lower in key_lower:
+                mapped_font = value
+                break
+        if mapped_font and platform.system() == "Windows":
+            try:
+                font_path = f"C:\\Windows\\Fonts\\{mapped_font}"
+                font = ImageFont.truetype(font_path, font_size)
+                font_loaded = True
+            except Exception as e:
+                pass
+    if not font_loaded:
+        system_fonts = []
+        if platform.system() == "Windows":
+            system_fonts = [
+                r"C:\Windows\Fonts\msyh.ttc",
+                r"C:\Windows\Fonts\simsun.ttc",
+                r"C:\Windows\Fonts\simhei.ttf",
+                r"C:\Windows\Fonts\simkai.ttf"
+            ]
+        elif platform.system() == "Darwin":
+            system_fonts = [
+                "/System/Library/Fonts/PingFang.ttc",
+                "/Library/Fonts/Arial Unicode.ttf",
+                "/System/Library/Fonts/STHeiti Light.ttc"
+            ]
+        elif platform.system() == "Linux":
+            system_fonts = [
+                "/usr/share/fonts/truetype/droid/DroidSansFallbackFull.ttf",
+                "/usr/share/fonts/truetype/wqy/wqy-microhei.ttc"
+            ]
+        local_fonts = [
+            "fonts/SimHei.ttf", 
+            "fonts/SimSun.ttf",
+            "fonts/msyh.ttc",
+            "SimHei.ttf", 
+            "SimSun.ttf"
+        ]
+        for font_path in system_fonts + local_fonts:
+            try:
+                font = ImageFont.truetype(font_path, font_size)
+                font_loaded = True
+                break
+            except:
+                continue
+    if not font_loaded:
+        font = ImageFont.load_default()
+    return font, text_color
+
+
+def reference_render_text_with_wrapping(draw, text, rect, font, text_color, align="left", v_align="center", text_strategy="auto"):
+    """优化前的文本换行与缩放逻辑, 原样保留作为回归测试的基准"""
+    left, top, right, bottom = rect
+    width = right - left
+    height = bottom - top
+
+    words = []
+    temp_word = ""
+    for char in text:
+        if ord(char) > 127:
+            if temp_word:
+                words.append(temp_word)
+                temp_word = ""
+            words.append(char)
+        elif char.isspace():
+            if temp_word:
+                words.append(temp_word)
+                temp_word = ""
+            words.append(" ")
+        else:
+            temp_word += char
+    if temp_word:
+        words.append(temp_word)
+
+    original_font_size = font.size if hasattr(font, 'size') else 12
+    current_font_size = original_font_size
+    font_size_min = max(8, int(original_font_size * 0.6))
+
+    final_font = font
+    final_lines = []
+
+    if text_strategy == "auto":
+        while current_font_size >= font_size_min:
+            if current_font_size != original_font_size:
+                try:
+                    if hasattr(font, 'path'):
+                        final_font = ImageFont.truetype(font.path, current_font_size)
+                    else:
+                        final_font = font
+                        break
+                except:
+                    final_font = font
+                    break
+            lines = []
+            line = ""
+            line_width = 0
+            for word in words:
+                word_width = draw.textlength(word, font=final_font)
+                if line_width + word_width <= width:
+                    line += word
+                    line_width += word_width
+                else:
+                    if line:
+                        lines.append(line)
+                    line = word
+                    line_width = word_width
+            if line:
+                lines.append(line)
+            line_height = current_font_size * 1.2
+            total_height = len(lines) * line_height
+            if total_height <= height or current_font_size <= font_size_min:
+                final_lines = lines
+                break
+            current_font_size -= 1
+    else:
+        lines = []
+        line = ""
+        line_width = 0
+        for word in words:
+            word_width = draw.textlength(word, font=font)
+            if line_width + word_width <= width:
+                line += word
+                line_width += word_width
+            else:
+                if line:
+                    lines.append(line)
+                line = word
+                line_width = word_width
+        if line:
+            lines.append(line)
+        final_lines = lines
+        final_font = font
+
+    line_height = final_font.size * 1.2 if hasattr(final_font, 'size') else 15
+    max_lines = max(1, int(height / line_height))
+    if len(final_lines) > max_lines:
+        if max_lines > 1:
+            final_lines = final_lines[:max_lines-1]
+            if len(final_lines[-1]) > 10:
+                final_lines.append(final_lines[-1][:10] + "...")
+            else:
+                final_lines.append("...")
+        else:
+            if len(final_lines[0]) > 10:
+                final_lines = [final_lines[0][:10] + "..."]
+            else:
+                final_lines = [final_lines[0]]
+
+    text_height = len(final_lines) * line_height
+    if v_align == "center":
+        y = top + (height - text_height) / 2
+    elif v_align == "bottom":
+        y = bottom - text_height
+    else:
+        y = top
+
+    for line in final_lines:
+        line_width = draw.textlength(line, font=final_font)
+        if align == "center":
+            x = left + (width - line_width) / 2
+        elif align == "right":
+            x = right - line_width
+        else:
+            x = left
+        draw.text((x, y), line, font=final_font, fill=text_color)
+        y += line_height
+
+
+
+# baseline 路径只作为比较基准; reference 指定与哪个基准比较, 默认与 reference 比较。
+# renderer 为 per_layer 的路径每行重新遍历并解码PSD图层(优化前的渲染方式), 其余路径先经过 compile_template
+RENDER_PATHS = {
+    "reference": {"renderer": "per_layer", "baseline": True},
+    "alpha_composite_reference": {"renderer": "per_layer", "compositor": "pillow_over", "baseline": True},
+    "compiled_template": {"text_backend": "pillow", "workers": 1},
+    "glyph_atlas": {"text_backend": "atlas", "workers": 1},
+    "threaded": {"text_backend": "pillow", "workers": 4},
+    "glyph_atlas_threaded": {"text_backend": "atlas", "workers": 4},
+    "shared_memory_process": {"text_backend": "pillow", "workers": 2, "worker_mode": "process"},
+    "alpha_composite_compiled": {"text_backend": "pillow", "workers": 1, "compositor": "pillow_over",
+                                 "reference": "alpha_composite_reference"},
+    "alpha_composite_threaded": {"text_backend": "pillow", "workers": 4, "compositor": "pillow_over",
+                                 "reference": "alpha_composite_reference"},
+    "numpy_composite": {"text_backend": "pillow", "workers": 1, "compositor": "numpy",
+                        "reference": "alpha_composite_reference"}
+}
+
+
+class SyntheticTypeLayer:
+    """回归测试用的文字图层替身
+
+    psd-tools 不能新建文字图层, 合成模板里的文字图层用它代替; 只提供 compile_template 和逐图层渲染用到的属性。
+    """
+
+    kind = "type"
+    opacity = 255
+
+    def __init__(self, name, bbox):
+        self.name = name
+        self.bbox = bbox
+
+    def has_pixels(self):
+        return False
+
+    def topil(self):
+        left, top, right, bottom = self.bbox
+        return Image.new("RGBA", (right - left, bottom - top), (255, 255, 255, 0))
+
+
+class SyntheticPsd:
+    """把从磁盘读回的 PSDImage 的像素图层和文字图层替身按绘制顺序组合在一起"""
+
+    def __init__(self, size, layers):
+        self.size = size
+        self.layers = layers
+
+    def __iter__(self):
+        return iter(self.layers)
+
+
+def build_synthetic_corpus(font_path, work_dir, seed=0, row_count=12, sizes=((800, 600), (1600, 1200))):
+    """生成用于像素回归测试的合成模板和数据行
+
+    每种尺寸写出一个真实的PSD文件再读回: 底部两个静态图层(渐变背景、色块)、三个不同对齐方式的文本图层、
+    图片图层和位于动态图层上方的半透明静态图层(图层不透明度 160);
+    数据行覆盖数字价格、中英文名称、会被截断的长文本和缺失的图片。
+    返回 (psd, text_layers, mapping, rows) 的列表。
+    """
+    rng = np.random.default_rng(seed)
+    for i in range(4):
+        swatch = rng.integers(0, 256, size=(90 + i * 40, 120 + i * 30, 4), dtype=np.uint8)
+        swatch[..., 3] = np.where(rng.random(swatch.shape[:2]) < 0.15, 0, 255)
+        Image.fromarray(swatch, "RGBA").save(os.path.join(work_dir, f"swatch_{i}.png"))
+
+    texts = ["¥19.90", "¥1,299.00", "苹果 Apple", "限时折扣 75%", "0123456789", "新品上市",
+             "A very long product description that will certainly need wrapping and truncation to fit"]
+    corpus = []
+    for width, height in sizes:
+        gradient = np.zeros((height, width, 4), dtype=np.uint8)
+        gradient[..., 0] = np.linspace(0, 255, width, dtype=np.uint8)[None, :]
+        gradient[..., 1] = np.linspace(255, 0, height, dtype=np.uint8)[:, None]
+        gradient[..., 2] = 128
+        gradient[..., 3] = 255
+        block = np.zeros((height // 5, width // 5, 4), dtype=np.uint8)
+        block[..., 0] = 240
+        block[..., 3] = np.linspace(0, 255, width // 5, dtype=np.uint8)[None, :]
+        overlay = np.zeros((height // 4, width // 2, 4), dtype=np.uint8)
+        overlay[..., :3] = 255
+        overlay[..., 3] = 96
+
+        psd = PSDImage.new("RGBA", (width, height))
+        psd.append(PixelLayer.frompil(Image.fromarray(gradient, "RGBA"), psd, "background"))
+        psd.append(PixelLayer.frompil(Image.fromarray(block, "RGBA"), psd, "block", height // 20, width // 20))
+        psd.append(PixelLayer.frompil(Image.fromarray(overlay, "RGBA"), psd, "photo", height // 10, width * 2 // 3))
+        overlay_layer = PixelLayer.frompil(Image.fromarray(overlay, "RGBA"), psd, "overlay", height // 2, width // 4)
+        overlay_layer.opacity = 160
+        psd.append(overlay_layer)
+        psd_path = os.path.join(work_dir, f"template_{width}x{height}.psd")
+        psd.save(psd_path)
+        background, block_layer, photo, overlay_layer = list(PSDImage.open(psd_path))
+
+        type_layers = []
+        text_layers = []
+        align_mapping = {}
+        for slot, (align, v_align) in enumerate([("left", "top"), ("center", "center"), ("right", "bottom")]):
+            left = width // 10
+            top = height // 10 + slot * height // 4
+            name = f"text_{slot}"
+            type_layers.append(SyntheticTypeLayer(name, (left, top, left + width // 2, top + height // 6)))
+            text_layers.append({"name": name, "font": None, "font_size": max(12, height // 20),
+                                "color": (20 * slot, 30, 200 - 40 * slot, 255)})
+            align_mapping[name] = (align, v_align)
+        mapping = {
+            "text_mapping": {layer["name"]: layer["name"] for layer in text_layers},
+            "image_mapping": {"photo": "photo"},
+            "font_mapping": {layer["name"]: font_path for layer in text_layers} if font_path else {},
+            "color_mapping": {},
+            "font_size_mapping": {},
+            "align_mapping": align_mapping
+        }
+        rows = []
+        for row_index in range(row_count):
+            row = {f"text_{slot}": texts[(row_index + slot * 3) % len(texts)] for slot in range(3)}
+            row["photo"] = f"swatch_{row_index % 5}.png"
+            rows.append(row)
+        layers = [background, block_layer] + type_layers + [photo, overlay_layer]
+        corpus.append((SyntheticPsd((width, height), layers), text_layers, mapping, rows))
+    return corpus
+
+
+def render_psd_row_per_layer(psd, text_layers, row, mapping, context):
+    """优化前的渲染方式: 每行从空白画布开始遍历PSD图层, 重新解码图层像素并按原来的内联逻辑查找字体、换行"""
+    compositor = context.get("compositor", "pillow")
+    final_image = Image.new('RGBA', psd.size, (255, 255, 255, 0))
+    for layer in psd:
+        left, top, right, bottom = layer.bbox
+        if layer.kind == 'type' and layer.name in mapping["text_mapping"]:
+            layer_info = next((l for l in text_layers if l['name'] == layer.name), None)
+            font, text_color = reference_load_font(layer.name, layer_info, mapping["font_mapping"],
+                                                   mapping["color_mapping"], mapping["font_size_mapping"])
+            text_layer = Image.new("RGBA", (right - left, bottom - top), (255, 255, 255, 0))
+            align, v_align = mapping["align_mapping"].get(layer.name, ("left", "center"))
+            reference_render_text_with_wrapping(ImageDraw.Draw(text_layer),
+                                                str(row[mapping["text_mapping"][layer.name]]),
+                                                (0, 0, right - left, bottom - top), font, text_color,
+                                                align, v_align, context["text_strategy"])
+            composite_layer(final_image, text_layer, (left, top), layer.opacity, compositor)
+            continue
+        if layer.has_pixels() and layer.name in mapping["image_mapping"]:
+            image_path = os.path.join(context["folder_path"], str(row[mapping["image_mapping"][layer.name]]).strip())
+            if os.path.exists(image_path):
+                new_image = Image.open(image_path).convert('RGBA').resize((right - left, bottom - top), Image.LANCZOS)
+                composite_layer(final_image, new_image, (left, top), layer.opacity, compositor)
+                continue
+        layer_image = layer.topil()
+        if layer_image is not None:
+            composite_layer(final_image, layer_image.convert('RGBA'), (left, top), layer.opacity, compositor)
+    return final_image
+
+
+def render_corpus_with_path(psd, text_layers, mapping, rows, folder_path, path_options, text_strategy="auto"):
+    """按 path_options 渲染一个合成模板的所有数据行, 计时包含编译模板、启动线程或子进程"""
+    context = {
+        "text_mapping": mapping["text_mapping"],
+        "image_mapping": mapping["image_mapping"],
+        "font_mapping": mapping["font_mapping"],
+        "align_mapping": mapping["align_mapping"],
+        "folder_path": folder_path,
+        "text_strategy": text_strategy,
+        "glyph_atlas": GlyphAtlas() if path_options.get("text_backend") == "atlas" else None,
+        "compositor": path_options.get("compositor", "pillow"),
+        "debug_sample": None,
+        "debug_writer": None,
+        # 语料中故意缺少的图片不输出警告
+        "log_text": QuietLog()
+    }
+    start = time.perf_counter()
+    if path_options.get("renderer") == "per_layer":
+        images = [render_psd_row_per_layer(psd, text_layers, row, mapping, context) for row in rows]
+        return images, time.perf_counter() - start
+    template = compile_template(psd, text_layers, mapping, context["compositor"])
+    if path_options.get("worker_mode") == "process":
+        shared_template = SharedTemplate(template)
+        worker_context = {key: value for key, value in context.items() if key not in ("glyph_atlas", "debug_writer")}
+        worker_context["text_backend"] = path_options.get("text_backend")
+        encode_plan = {"image_format": "PNG", "output_sizes": [], "variant_formats": {}}
+        try:
+            with create_process_executor(shared_template, path_options.get("workers", 1), worker_context,
+                                         encode_plan) as executor:
+                results = list(executor.map(render_row_in_worker, rows, range(len(rows))))
+        finally:
+            shared_template.close()
+        images = [Image.open(io.BytesIO(result["image"])) for result in results]
+        return images, time.perf_counter() - start
+    with ThreadPoolExecutor(max_workers=path_options.get("workers", 1)) as executor:
+        images = list(executor.map(lambda item: render_psd_row(template, item[1], item[0], context), enumerate(rows)))
+    return images, time.perf_counter() - start
+
+
+def run_shard_regression(work_dir, row_count=25, shard_size=10, seed=0):
+    """把不同尺寸的随机图片写入 ZIP/TAR 分卷, 按 index.csv 逐行读回并与写入的数据逐字节比较
+
+    返回 {输出格式: 读回失败的行号列表}。
+    """
+    rng = np.random.default_rng(seed)
+    images = [Image.fromarray(rng.integers(0, 256, size=(20 + i * 7, 30 + i * 5, 4), dtype=np.uint8), "RGBA")
+              for i in range(row_count)]
+    results = {}
+    for archive_format in ("zip", "tar"):
+        for image_format in ("PNG", "JPEG"):
+            output_dir = os.path.join(work_dir, f"shards_{archive_format}_{image_format}")
+            os.makedirs(output_dir, exist_ok=True)
+            sink = ArchiveShardSink(output_dir, archive_format, shard_size, image_format)
+            encoded = {}
+            for index, image in enumerate(images):
+                encoded[index + 1] = encode_image(image, image_format)
+                sink.write_encoded(index, encoded[index + 1])
+            sink.close()
+            failed_rows = verify_shard_index(output_dir)
+            with open(os.path.join(output_dir, "index.csv"), newline="", encoding="utf-8") as index_file:
+                for record in csv.DictReader(index_file):
+                    with open(os.path.join(output_dir, record["shard"]), "rb") as shard:
+                        shard.seek(int(record["offset"]))
+                        if shard.read(int(record["size"])) != encoded[int(record["row"])]:
+                            failed_rows.append(int(record["row"]))
+            results[f"{archive_format}/{image_format}"] = sorted(set(failed_rows))
+    return results
+
+
+def compute_ssim(reference, candidate, window=7):
+    """灰度图的平均 SSIM, 用均值滤波窗口近似, 仅依赖 numpy"""
+    c1 = (0.01 * 255) ** 2
+    c2 = (0.03 * 255) ** 2
+
+    def box_filter(values):
+        padded = np.pad(values, ((1, 0), (1, 0)))
+        summed = padded.cumsum(axis=0).cumsum(axis=1)
+        total = (summed[window:, window:] - summed[:-window, window:]
+                 - summed[window:, :-window] + summed[:-window, :-window])
+        return total / (window * window)
+
+    x = reference.astype(np.float64)
+    y = candidate.astype(np.float64)
+    mu_x = box_filter(x)
+    mu_y = box_filter(y)
+    sigma_x = box_filter(x * x) - mu_x ** 2
+    sigma_y = box_filter(y * y) - mu_y ** 2
+    sigma_xy = box_filter(x * y) - mu_x * mu_y
+    ssim_map = ((2 * mu_x * mu_y + c1) * (2 * sigma_xy + c2)) / ((mu_x ** 2 + mu_y ** 2 + c1) * (sigma_x + sigma_y + c2))
+    return float(ssim_map.mean())
+
+
+def compare_images(reference, candidate, pixel_tolerance=2):
+    reference_array = np.asarray(reference.convert("RGBA"), dtype=np.int16)
+    candidate_array = np.asarray(candidate.convert("RGBA"), dtype=np.int16)
+    if reference_array.shape != candidate_array.shape:
+        return {"max_diff": 255, "mismatch_ratio": 1.0, "psnr": 0.0, "ssim": 0.0}
+    diff = np.abs(reference_array - candidate_array)
+    mse = float((diff.astype(np.float64) ** 2).mean())
+    reference_gray = np.asarray(flatten_to_rgb(reference).convert("L"))
+    candidate_gray = np.asarray(flatten_to_rgb(candidate).convert("L"))
+    return {
+        "max_diff": int(diff.max()),
+        "mismatch_ratio": float(np.count_nonzero(diff.max(axis=2) > pixel_tolerance)) / (diff.shape[0] * diff.shape[1]),
+        "psnr": float("inf") if mse == 0 else 10 * math.log10(255 ** 2 / mse),
+        "ssim": compute_ssim(reference_gray, candidate_gray)
+    }
+
+
+def run_pixel_regression(font_path=None, paths=None, pixel_tolerance=2, max_mismatch_ratio=0.001, min_ssim=0.995,
+                         diff_dir=None, seed=0, row_count=12, sizes=((800, 600), (1600, 1200))):
+    """把合成模板分别用参考路径和各个优化路径渲染, 逐像素比较并记录吞吐量
+
+    每个优化路径都要满足: 超过 pixel_tolerance 的像素比例不超过 max_mismatch_ratio, 且 SSIM 不低于 min_ssim。
+    diff_dir 不为空时, 为不通过的行保存差异图。
+    """
+    if font_path is None:
+        available_fonts = list_available_fonts()
+        font_path = available_fonts[0] if available_fonts else None
+    paths = paths or [name for name, options in RENDER_PATHS.items() if not options.get("baseline")]
+    baselines = ["reference"]
+    for name in paths:
+        reference_name = RENDER_PATHS[name].get("reference", "reference")
+        if reference_name not in baselines:
+            baselines.append(reference_name)
+    if diff_dir:
+        os.makedirs(diff_dir, exist_ok=True)
+
+    results = {name: {"path": name, "rows": 0, "seconds": 0.0, "max_diff": 0, "mismatch_ratio": 0.0,
+                      "min_psnr": float("inf"), "min_ssim": 1.0, "failed_rows": 0}
+               for name in baselines + paths}
+    with tempfile.TemporaryDirectory() as work_dir:
+        corpus = build_synthetic_corpus(font_path, work_dir, seed, row_count, sizes)
+        for template_index, (psd, text_layers, mapping, rows) in enumerate(corpus):
+            reference_images = {}
+            for name in baselines:
+                reference_images[name], seconds = render_corpus_with_path(psd, text_layers, mapping, rows, work_dir,
+                                                                          RENDER_PATHS[name])
+                results[name]["rows"] += len(rows)
+                results[name]["seconds"] += seconds
+            for name in paths:
+                images, seconds = render_corpus_with_path(psd, text_layers, mapping, rows, work_dir, RENDER_PATHS[name])
+                result = results[name]
+                result["rows"] += len(rows)
+                result["seconds"] += seconds
+                references = reference_images[RENDER_PATHS[name].get("reference", "reference")]
+                for row_index, (reference, candidate) in enumerate(zip(references, images)):
+                    comparison = compare_images(reference, candidate, pixel_tolerance)
+                    result["max_diff"] = max(result["max_diff"], comparison["max_diff"])
+                    result["mismatch_ratio"] = max(result["mismatch_ratio"], comparison["mismatch_ratio"])
+                    result["min_psnr"] = min(result["min_psnr"], comparison["psnr"])
+                    result["min_ssim"] = min(result["min_ssim"], comparison["ssim"])
+                    if comparison["mismatch_ratio"] > max_mismatch_ratio or comparison["ssim"] < min_ssim:
+                        result["failed_rows"] += 1
+                        if diff_dir:
+                            diff = ImageChops.difference(reference.convert("RGB"), candidate.convert("RGB"))
+                            diff.point(lambda v: min(255, v * 8)).save(
+                                os.path.join(diff_dir, f"{name}_{template_index}_{row_index + 1}.png"))
+
+    for result in results.values():
+        result["rows_per_second"] = result["rows"] / result["seconds"] if result["seconds"] else 0.0
+        result["passed"] = result["failed_rows"] == 0
+    return list(results.values())
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    if len(sys.argv) > 2 and sys.argv[1] == "--benchmark-text":
+        for key, value in benchmark_text_backends(sys.argv[2]).items():
+            print(f"{key}: {value}")
+        sys.exit(0)
+    if len(sys.argv) < 2 or sys.argv[1] not in ("--regression", "--benchmark-composite"):
+        print(__doc__)
+        sys.exit(2)
+    font_arg = sys.argv[2] if len(sys.argv) > 2 else None
+    if sys.argv[1] == "--regression":
+        # 只有显式给出目录时才保存差异图
+        regression_results = run_pixel_regression(font_arg, diff_dir=sys.argv[3] if len(sys.argv) > 3 else None)
+    else:
+        # 大画布上比较 paste、alpha_composite 与 numpy 合成的吞吐量
+        regression_results = run_pixel_regression(font_arg,
+                                                  paths=["compiled_template", "alpha_composite_compiled",
+                                                         "numpy_composite"],
+                                                  row_count=4, sizes=((4000, 3000),))
+    for result in regression_results:
+        print(f"{result['path']:<26} {'通过' if result['passed'] else '不通过'}  "
+              f"{result['rows_per_second']:8.1f} 行/秒  最大差值 {result['max_diff']:3d}  "
+              f"超差比例 {result['mismatch_ratio']:.5f}  最小SSIM {result['min_ssim']:.4f}  "
+              f"最小PSNR {result['min_psnr']:.1f}")
+    shards_passed = True
+    if sys.argv[1] == "--regression":
+        with tempfile.TemporaryDirectory() as shard_dir:
+            for name, failed_rows in run_shard_regression(shard_dir).items():
+                shards_passed = shards_passed and not failed_rows
+                print(f"分卷索引 {name:<10} {'通过' if not failed_rows else f'不通过: 第 {failed_rows[:10]} 行'}")
+    sys.exit(0 if shards_passed and all(result["passed"] for result in regression_results) else 1)
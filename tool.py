@@ -1,14 +1,27 @@
 import tkinter as tk
 from tkinter import ttk, filedialog, colorchooser
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw, ImageFont, ImageTk, TiffImagePlugin
 from psd_tools import PSDImage
 import os
+import io
+import math
+import functools
+import csv
+import time
+import tarfile
+import zipfile
 import sys
 import platform
+import numpy as np
 import pandas as pd
 import queue
 import traceback
 import threading
+import collections
+import gc
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 
 def get_font_filename_map():
@@ -46,7 +59,11 @@ class ToolTip:
         self.widget.bind("<Leave>", self.hide_tooltip)
 
     def show_tooltip(self, event=None):
-        x, y, _, _ = self.widget.bbox("insert")
+        # 只有输入框等带文本光标的控件支持 bbox("insert"); 复选框等控件会把它当作 grid_bbox 并报错, 改按控件左上角定位
+        try:
+            x, y, _, _ = self.widget.bbox("insert")
+        except (tk.TclError, TypeError, ValueError):
+            x, y = 0, 0
         x += self.widget.winfo_rootx() + 25
         y += self.widget.winfo_rooty() + 25
         self.tooltip = tk.Toplevel(self.widget)
@@ -61,7 +78,49 @@ class ToolTip:
             self.tooltip = None
 
 
-def create_mapping_ui(text_layers, image_layers, excel_columns, parent_window):
+ALIGN_OPTIONS = [
+    ("左上", ("left", "top")),
+    ("中上", ("center", "top")),
+    ("右上", ("right", "top")),
+    ("左中", ("left", "center")),
+    ("中中", ("center", "center")),
+    ("右中", ("right", "center")),
+    ("左下", ("left", "bottom")),
+    ("中下", ("center", "bottom")),
+    ("右下", ("right", "bottom"))
+]
+
+
+def normalize_match_name(name):
+    return "".join(ch for ch in str(name).lower() if not ch.isspace() and ch not in "_-")
+
+
+def auto_match_columns(layer_names, excel_columns):
+    """按名称把图层自动匹配到Excel列: 先找规范化后完全相同的列, 再找唯一的包含关系"""
+    normalized_columns = {}
+    for column in excel_columns:
+        normalized_columns.setdefault(normalize_match_name(column), str(column))
+    matches = {}
+    for layer_name in layer_names:
+        key = normalize_match_name(layer_name)
+        if not key:
+            continue
+        if key in normalized_columns:
+            matches[layer_name] = normalized_columns[key]
+            continue
+        candidates = [column for normalized, column in normalized_columns.items()
+                      if normalized and (normalized in key or key in normalized)]
+        if len(candidates) == 1:
+            matches[layer_name] = candidates[0]
+    return matches
+
+
+def create_mapping_ui(text_layers, image_layers, excel_columns, parent_window, preview=None):
+    """映射设置窗口
+
+    preview 不为空时({"psd", "df", "folder_path", "text_strategy"}), 右侧显示所选数据行的低分辨率预览,
+    任何设置变化后只重新渲染受影响的图层。
+    """
     mapping_result = {
         "text_mapping": {},
         "image_mapping": {},
@@ -72,59 +131,179 @@ def create_mapping_ui(text_layers, image_layers, excel_columns, parent_window):
         "align_mapping": {}
     }
 
+    dialog_width = 1050 + (PREVIEW_SIZE + 40 if preview else 0)
+    dialog_height = 650 if preview else 600
     dialog = tk.Toplevel(parent_window)
     dialog.title("选择映射关系")
-    dialog.geometry("1050x600")
+    dialog.geometry(f"{dialog_width}x{dialog_height}")
     dialog.transient(parent_window)
     dialog.grab_set()
 
-    x = parent_window.winfo_x() + (parent_window.winfo_width() - 1050) // 2
-    y = parent_window.winfo_y() + (parent_window.winfo_height() - 600) // 2
+    x = parent_window.winfo_x() + (parent_window.winfo_width() - dialog_width) // 2
+    y = parent_window.winfo_y() + (parent_window.winfo_height() - dialog_height) // 2
     dialog.geometry(f"+{x}+{y}")
 
-    notebook = ttk.Notebook(dialog)
-    notebook.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+    preview_state = {"renderer": None, "dirty": set(), "job": None, "thread": None, "cancel": threading.Event()}
+    if preview:
+        preview_frame = ttk.LabelFrame(dialog, text="预览", padding=5)
+        preview_frame.pack(side=tk.RIGHT, fill=tk.Y, padx=(0, 10), pady=10)
+        preview_row_frame = ttk.Frame(preview_frame)
+        preview_row_frame.pack(fill=tk.X)
+        ttk.Label(preview_row_frame, text=f"数据行(1-{len(preview['df'])}):").pack(side=tk.LEFT)
+        preview_row_var = tk.StringVar(value="1")
+        preview_time_var = tk.StringVar()
+        ttk.Label(preview_row_frame, textvariable=preview_time_var).pack(side=tk.RIGHT)
+        preview_label = ttk.Label(preview_frame, text="正在生成预览...", anchor="center")
+        preview_label.pack(fill=tk.BOTH, expand=True, pady=5)
+
+    def schedule_preview(layer_name=None):
+        """记录需要重新渲染的图层, 合并短时间内的多次修改后再刷新预览"""
+        if not preview:
+            return
+        if layer_name is None:
+            preview_state["dirty"] = None
+        elif preview_state["dirty"] is not None:
+            preview_state["dirty"].add(layer_name)
+        if preview_state["renderer"] is None:
+            return
+        if preview_state["job"] is not None:
+            dialog.after_cancel(preview_state["job"])
+        preview_state["job"] = dialog.after(80, update_preview)
 
-    text_frame = ttk.Frame(notebook, padding=10)
-    notebook.add(text_frame, text="文本、字体与颜色映射")
+    def update_preview():
+        preview_state["job"] = None
+        try:
+            row_number = int(preview_row_var.get())
+        except ValueError:
+            return
+        df = preview["df"]
+        if not 1 <= row_number <= len(df):
+            return
+        start_time = time.perf_counter()
+        image, errors = preview_state["renderer"].update(df.iloc[row_number - 1], text_states, image_states,
+                                                         preview_state["dirty"])
+        preview_state["dirty"] = set()
+        photo = ImageTk.PhotoImage(image)
+        if errors:
+            # 出错的图层按原图显示, 错误信息显示在预览图下方
+            preview_label.config(image=photo, text="无法生成预览: " + "; ".join(errors), compound=tk.BOTTOM)
+        else:
+            preview_label.config(image=photo, text="", compound=tk.NONE)
+        preview_label.image = photo
+        preview_time_var.set(f"{(time.perf_counter() - start_time) * 1000:.0f} ms")
+
+    def stop_preview():
+        if preview_state["job"] is not None:
+            dialog.after_cancel(preview_state["job"])
+            preview_state["job"] = None
+        # 后台线程仍在编译预览时, 让它在下一个图层前退出并等它结束,
+        # 关闭窗口后处理流程会在同一个 PSDImage 上编译模板, 两者不能同时读取图层
+        preview_state["cancel"].set()
+        if preview_state["thread"] is not None:
+            preview_state["thread"].join()
 
-    ttk.Label(text_frame, text="请选择PSD文本图层与Excel列的映射关系、使用的字体和颜色:").pack(pady=5)
+    notebook = ttk.Notebook(dialog)
+    notebook.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
 
-    text_canvas = tk.Canvas(text_frame, borderwidth=0)
-    text_scrollbar = ttk.Scrollbar(text_frame, orient="vertical", command=text_canvas.yview)
-    text_scrollable_frame = ttk.Frame(text_canvas)
+    column_values = ["不替换"] + [str(column) for column in excel_columns]
+    align_labels = {align: text for text, align in ALIGN_OPTIONS}
+    font_map = {k.lower().replace(" ", ""): v for k, v in get_font_filename_map().items()}
+    system_font_folder = get_system_font_folder()
 
-    text_scrollable_frame.bind(
-        "<Configure>",
-        lambda e: text_canvas.configure(scrollregion=text_canvas.bbox("all"))
-    )
+    # 每个图层的设置只保存在字典里, Treeview 只显示文本, 编辑控件只有下方一套, 作用于所有选中的图层
+    text_states = {}
+    for layer in text_layers:
+        original_size = layer.get('font_size') or 12
+        if isinstance(original_size, float):
+            original_size = int(original_size)
+        suggestion = ""
+        if layer['font'] and isinstance(layer['font'], dict) and 'Name' in layer['font']:
+            font_file = font_map.get(layer['font']['Name'].lower().replace(" ", ""))
+            if font_file:
+                suggestion = os.path.join(system_font_folder, font_file)
+        text_states[layer['name']] = {
+            "column": "不替换",
+            "font": "保持原始字体",
+            "size": str(original_size),
+            "color": layer.get('color') or (0, 0, 0, 255),
+            "color_changed": False,
+            "align": ("left", "top"),
+            "info": f"原始字体: {layer['font'] if layer['font'] else '未知'}, 大小: {layer['font_size'] or '未知'}",
+            "suggestion": suggestion
+        }
+    image_states = {layer['name']: {"column": "不替换"} for layer in image_layers}
 
-    text_canvas.create_window((0, 0), window=text_scrollable_frame, anchor="nw")
-    text_canvas.configure(yscrollcommand=text_scrollbar.set)
+    text_frame = ttk.Frame(notebook, padding=10)
+    notebook.add(text_frame, text="文本、字体与颜色映射")
 
-    text_canvas.pack(side="left", fill="both", expand=True, pady=5)
+    top_frame = ttk.Frame(text_frame)
+    top_frame.pack(fill=tk.X, pady=5)
+    ttk.Label(top_frame, text="请选择PSD文本图层与Excel列的映射关系、使用的字体和颜色(可按住Ctrl/Shift多选后批量修改):").pack(side=tk.LEFT)
+
+    tree_frame = ttk.Frame(text_frame)
+    tree_frame.pack(fill=tk.BOTH, expand=True, pady=5)
+    text_columns = ("layer", "column", "font", "size", "color", "align", "info")
+    text_tree = ttk.Treeview(tree_frame, columns=text_columns, show="headings", selectmode="extended")
+    for column, heading, width in [("layer", "图层名称", 140), ("column", "对应Excel列", 130), ("font", "字体文件", 220),
+                                   ("size", "字体大小", 60), ("color", "文本颜色", 80), ("align", "对齐方式", 60),
+                                   ("info", "原始信息 / 建议字体", 300)]:
+        text_tree.heading(column, text=heading)
+        text_tree.column(column, width=width, stretch=column in ("font", "info"))
+    text_scrollbar = ttk.Scrollbar(tree_frame, orient="vertical", command=text_tree.yview)
+    text_tree.configure(yscrollcommand=text_scrollbar.set)
+    text_tree.pack(side="left", fill="both", expand=True)
     text_scrollbar.pack(side="right", fill="y")
 
-    header_frame = ttk.Frame(text_scrollable_frame)
-    header_frame.pack(fill=tk.X, pady=5)
-
-    ttk.Label(header_frame, text="图层名称", width=10).grid(row=0, column=0, padx=5)
-    ttk.Label(header_frame, text="对应Excel列", width=20).grid(row=0, column=1, padx=5)
-    ttk.Label(header_frame, text="字体文件", width=43).grid(row=0, column=2, padx=5)
-    ttk.Label(header_frame, text="字体大小", width=10).grid(row=0, column=3, padx=5)
-    ttk.Label(header_frame, text="文本颜色", width=13).grid(row=0, column=4, padx=5)
-    ttk.Label(header_frame, text="对齐方式", width=10).grid(row=0, column=5, padx=5)
-
-    ttk.Separator(text_scrollable_frame, orient="horizontal").pack(fill=tk.X, pady=5)
-
-    text_comboboxes = []
-    font_entries = []
-    font_size_entries = []
-    color_selections = {}
-    color_labels = {}
-    align_labels = {}
+    def color_to_hex(color):
+        r, g, b = color[:3]
+        return f"#{r:02x}{g:02x}{b:02x}"
+
+    def refresh_text_row(layer_name):
+        state = text_states[layer_name]
+        info = state["info"]
+        if state["suggestion"]:
+            info += f"  建议字体: {state['suggestion']}"
+        text_tree.item(layer_name, values=(layer_name, state["column"], state["font"], state["size"],
+                                           color_to_hex(state["color"]), align_labels[state["align"]], info))
+        schedule_preview(layer_name)
+
+    for layer in text_layers:
+        if not text_tree.exists(layer['name']):
+            text_tree.insert("", "end", iid=layer['name'])
+            refresh_text_row(layer['name'])
+
+    editor_frame = ttk.LabelFrame(text_frame, text="编辑选中的图层", padding=5)
+    editor_frame.pack(fill=tk.X, pady=5)
+
+    loading = {"active": False}
+    column_var = tk.StringVar(value="不替换")
+    font_var = tk.StringVar(value="保持原始字体")
+    font_size_var = tk.StringVar(value="12")
+    selection_var = tk.StringVar(value="未选择图层")
+
+    ttk.Label(editor_frame, textvariable=selection_var, width=20).grid(row=0, column=0, rowspan=2, sticky="w", padx=5)
+    ttk.Label(editor_frame, text="对应Excel列").grid(row=0, column=1, sticky="w", padx=5)
+    column_combo = ttk.Combobox(editor_frame, textvariable=column_var, values=column_values, width=20, state="readonly")
+    column_combo.grid(row=1, column=1, padx=5)
+
+    ttk.Label(editor_frame, text="字体文件").grid(row=0, column=2, sticky="w", padx=5)
+    font_frame = ttk.Frame(editor_frame)
+    font_frame.grid(row=1, column=2, padx=5)
+    ttk.Entry(font_frame, textvariable=font_var, width=30).pack(side=tk.LEFT, padx=2)
+
+    def selected_text_layers():
+        return list(text_tree.selection())
+
+    def apply_to_selection(key, value):
+        if loading["active"]:
+            return
+        for layer_name in selected_text_layers():
+            text_states[layer_name][key] = value
+            if key == "color":
+                text_states[layer_name]["color_changed"] = True
+            refresh_text_row(layer_name)
 
-    def browse_font(entry_var):
+    def browse_font():
         initial_dir = get_system_font_folder()
         font_file = filedialog.askopenfilename(
             parent=dialog,
@@ -133,197 +312,191 @@ def create_mapping_ui(text_layers, image_layers, excel_columns, parent_window):
             initialdir=initial_dir
         )
         if font_file:
-            entry_var.set(font_file)
+            font_var.set(font_file)
 
-    def choose_color(layer_name):
-        initial_color = color_selections.get(layer_name)
-        if initial_color:
-            r, g, b, _ = initial_color
-            hex_color = f"#{r:02x}{g:02x}{b:02x}"
-        else:
-            hex_color = "#000000"
-        color = colorchooser.askcolor(hex_color, parent=dialog, title=f"为'{layer_name}'选择颜色")
-        if color[1]:
-            hex_color = color[1]
-            r, g, b = tuple(int(hex_color[i:i+2], 16) for i in (1, 3, 5))
-            new_color = (r, g, b, 255)
-            color_selections[layer_name] = new_color
-            color_labels[layer_name].config(background=hex_color)
-            mapping_result["color_mapping"][layer_name] = new_color
-
-    def set_align(layer_name, align):
-        mapping_result["align_mapping"][layer_name] = align
-        align_labels[layer_name].config(text=f"{align[0]} {align[1]}")
-
-    for i, layer in enumerate(text_layers):
-        row_frame = ttk.Frame(text_scrollable_frame)
-        row_frame.pack(fill=tk.X, pady=3)
-
-        layer_name = layer['name']
-        layer_label = ttk.Label(row_frame, text=layer_name[:10], width=10)
-        layer_label.pack(side=tk.LEFT, padx=5)
-        ToolTip(layer_label, layer_name)
-
-        data_combo = ttk.Combobox(row_frame, values=["不替换"] + excel_columns, width=20)
-        data_combo.pack(side=tk.LEFT, padx=5)
-        data_combo.current(0)
-
-        font_frame = ttk.Frame(row_frame)
-        font_frame.pack(side=tk.LEFT, padx=5, fill=tk.X, expand=True)
-        font_var = tk.StringVar(value="保持原始字体")
-        font_entry = ttk.Entry(font_frame, textvariable=font_var, width=30)
-        font_entry.pack(side=tk.LEFT, padx=2)
-        font_btn = ttk.Button(font_frame, text="浏览...", width=8, command=lambda v=font_var: browse_font(v))
-        font_btn.pack(side=tk.LEFT, padx=2)
-
-        font_size_frame = ttk.Frame(row_frame)
-        font_size_frame.pack(side=tk.LEFT, padx=5)
-        original_size = layer.get('font_size', 12)
-        if isinstance(original_size, float):
-            original_size = int(original_size)
-        font_size_var = tk.StringVar(value=str(original_size))
-        font_size_entry = ttk.Entry(font_size_frame, textvariable=font_size_var, width=5)
-        font_size_entry.pack(side=tk.LEFT)
-        size_buttons_frame = ttk.Frame(font_size_frame)
-        size_buttons_frame.pack(side=tk.LEFT)
+    ttk.Button(font_frame, text="浏览...", width=8, command=browse_font).pack(side=tk.LEFT, padx=2)
 
-        def increase_size(size_var):
-            try:
-                current = int(size_var.get())
-                size_var.set(str(current + 1))
-            except ValueError:
-                size_var.set("12")
+    ttk.Label(editor_frame, text="字体大小").grid(row=0, column=3, sticky="w", padx=5)
+    font_size_frame = ttk.Frame(editor_frame)
+    font_size_frame.grid(row=1, column=3, padx=5)
+    ttk.Entry(font_size_frame, textvariable=font_size_var, width=5).pack(side=tk.LEFT)
+    size_buttons_frame = ttk.Frame(font_size_frame)
+    size_buttons_frame.pack(side=tk.LEFT)
 
-        def decrease_size(size_var):
+    def change_size(delta):
+        # 多选时按各自当前的字号分别增减
+        for layer_name in selected_text_layers():
+            state = text_states[layer_name]
             try:
-                current = int(size_var.get())
-                if current > 1:
-                    size_var.set(str(current - 1))
+                current = int(state["size"])
+                state["size"] = str(max(1, current + delta))
             except ValueError:
-                size_var.set("12")
-
-        ttk.Button(size_buttons_frame, text="▲", width=2, command=lambda v=font_size_var: increase_size(v)).pack(fill=tk.X)
-        ttk.Button(size_buttons_frame, text="▼", width=2, command=lambda v=font_size_var: decrease_size(v)).pack(fill=tk.X)
-
-        color_frame = ttk.Frame(row_frame)
-        color_frame.pack(side=tk.LEFT, padx=5)
-        initial_color = layer.get('color', (0, 0, 0, 255))
-        if initial_color:
-            r, g, b = initial_color[:3]
-            hex_color = f"#{r:02x}{g:02x}{b:02x}"
-        else:
-            hex_color = "#000000"
-        color_label = tk.Label(color_frame, background=hex_color, width=3, height=1)
-        color_label.pack(side=tk.LEFT)
-        color_selections[layer_name] = initial_color
-        color_labels[layer_name] = color_label
-        color_btn = ttk.Button(color_frame, text="选择", width=8, command=lambda name=layer_name: choose_color(name))
-        color_btn.pack(side=tk.LEFT, padx=2)
-
-        align_frame = ttk.Frame(row_frame)
-        align_frame.pack(side=tk.LEFT, padx=5)
-
-        align_options = [
-            ("左上", ("left", "top")),
-            ("中上", ("center", "top")),
-            ("右上", ("right", "top")),
-            ("左中", ("left", "center")),
-            ("中中", ("center", "center")),
-            ("右中", ("right", "center")),
-            ("左下", ("left", "bottom")),
-            ("中下", ("center", "bottom")),
-            ("右下", ("right", "bottom"))
-        ]
+                state["size"] = "12"
+            refresh_text_row(layer_name)
+        load_editor()
+
+    ttk.Button(size_buttons_frame, text="▲", width=2, command=lambda: change_size(1)).pack(fill=tk.X)
+    ttk.Button(size_buttons_frame, text="▼", width=2, command=lambda: change_size(-1)).pack(fill=tk.X)
+
+    ttk.Label(editor_frame, text="文本颜色").grid(row=0, column=4, sticky="w", padx=5)
+    color_frame = ttk.Frame(editor_frame)
+    color_frame.grid(row=1, column=4, padx=5)
+    color_label = tk.Label(color_frame, background="#000000", width=3, height=1)
+    color_label.pack(side=tk.LEFT)
+
+    def choose_color():
+        layer_names = selected_text_layers()
+        if not layer_names:
+            return
+        title_name = layer_names[0] if len(layer_names) == 1 else f"{len(layer_names)} 个图层"
+        color = colorchooser.askcolor(color_to_hex(text_states[layer_names[0]]["color"]), parent=dialog,
+                                      title=f"为'{title_name}'选择颜色")
+        if color[1]:
+            hex_color = color[1]
+            r, g, b = tuple(int(hex_color[i:i+2], 16) for i in (1, 3, 5))
+            apply_to_selection("color", (r, g, b, 255))
+            color_label.config(background=hex_color)
+
+    ttk.Button(color_frame, text="选择", width=8, command=choose_color).pack(side=tk.LEFT, padx=2)
+
+    ttk.Label(editor_frame, text="对齐方式").grid(row=0, column=5, sticky="w", padx=5)
+    align_frame = ttk.Frame(editor_frame)
+    align_frame.grid(row=1, column=5, padx=5)
+    for j, (text, align) in enumerate(ALIGN_OPTIONS):
+        ttk.Button(align_frame, text=text, width=5,
+                   command=lambda a=align: apply_to_selection("align", a)).grid(row=j // 3, column=j % 3, padx=2, pady=1)
+
+    def load_editor(event=None):
+        layer_names = selected_text_layers()
+        if not layer_names:
+            selection_var.set("未选择图层")
+            return
+        state = text_states[layer_names[0]]
+        selection_var.set(layer_names[0][:20] if len(layer_names) == 1 else f"已选择 {len(layer_names)} 个图层")
+        loading["active"] = True
+        column_var.set(state["column"])
+        font_var.set(state["font"])
+        font_size_var.set(state["size"])
+        color_label.config(background=color_to_hex(state["color"]))
+        loading["active"] = False
+
+    text_tree.bind("<<TreeviewSelect>>", load_editor)
+    column_combo.bind("<<ComboboxSelected>>", lambda e: apply_to_selection("column", column_var.get()))
+    font_var.trace_add("write", lambda *args: apply_to_selection("font", font_var.get()))
+    font_size_var.trace_add("write", lambda *args: apply_to_selection("size", font_size_var.get()))
 
-        for j, (text, align) in enumerate(align_options):
-            ttk.Button(align_frame, text=text, width=5,
-                       command=lambda n=layer_name, a=align: set_align(n, a)).grid(row=j // 3, column=j % 3, padx=2, pady=1)
+    image_frame = ttk.Frame(notebook, padding=10)
+    notebook.add(image_frame, text="图像映射")
 
-        align_label = ttk.Label(align_frame, text="左上", width=10)
-        align_label.grid(row=3, column=0, columnspan=3, pady=2)
-        align_labels[layer_name] = align_label
-        mapping_result["align_mapping"][layer_name] = ("left", "top")
+    ttk.Label(image_frame, text="请选择PSD图像图层与Excel列(包含图像文件名)的映射关系:").pack(pady=5)
 
-        text_comboboxes.append((layer_name, data_combo))
-        font_entries.append((layer_name, font_var))
-        font_size_entries.append((layer_name, font_size_var))
+    image_tree_frame = ttk.Frame(image_frame)
+    image_tree_frame.pack(fill=tk.BOTH, expand=True, pady=5)
+    image_tree = ttk.Treeview(image_tree_frame, columns=("layer", "column"), show="headings", selectmode="extended")
+    image_tree.heading("layer", text="图层名称")
+    image_tree.heading("column", text="对应Excel列")
+    image_scrollbar = ttk.Scrollbar(image_tree_frame, orient="vertical", command=image_tree.yview)
+    image_tree.configure(yscrollcommand=image_scrollbar.set)
+    image_tree.pack(side="left", fill="both", expand=True)
+    image_scrollbar.pack(side="right", fill="y")
 
-        info_frame = ttk.Frame(text_scrollable_frame)
-        info_frame.pack(fill=tk.X, pady=0)
-        font_info = f"原始字体: {layer['font']}" if layer['font'] else "原始字体: 未知"
-        size_info = f"大小: {layer['font_size']}" if layer['font_size'] else "大小: 未知"
-        color_info = f"颜色: {layer['color']}" if layer['color'] else "颜色: 未知"
-        ttk.Label(info_frame, text=f"    {font_info}, {size_info}, {color_info}", foreground="gray").pack(side=tk.LEFT, padx=5)
+    def refresh_image_row(layer_name):
+        image_tree.item(layer_name, values=(layer_name, image_states[layer_name]["column"]))
+        schedule_preview(layer_name)
 
-        if layer['font'] and isinstance(layer['font'], dict) and 'Name' in layer['font']:
-            font_name = layer['font']['Name']
-            system_font_folder = get_system_font_folder()
-            font_map = get_font_filename_map()
-            if font_name.lower().replace(" ", "") in [k.lower().replace(" ", "") for k in font_map.keys()]:
-                for k, v in font_map.items():
-                    if k.lower().replace(" ", "") == font_name.lower().replace(" ", ""):
-                        suggestion = os.path.join(system_font_folder, v)
-                        ttk.Label(info_frame, text=f"建议字体: {suggestion}", foreground="blue").pack(side=tk.LEFT, padx=5)
-                        break
+    for layer in image_layers:
+        if not image_tree.exists(layer['name']):
+            image_tree.insert("", "end", iid=layer['name'])
+            refresh_image_row(layer['name'])
 
-        ttk.Separator(text_scrollable_frame, orient="horizontal").pack(fill=tk.X, pady=5)
+    image_editor_frame = ttk.Frame(image_frame)
+    image_editor_frame.pack(fill=tk.X, pady=5)
+    ttk.Label(image_editor_frame, text="选中图层对应Excel列:").pack(side=tk.LEFT, padx=5)
+    image_column_var = tk.StringVar(value="不替换")
+    image_combo = ttk.Combobox(image_editor_frame, textvariable=image_column_var, values=column_values, width=25,
+                               state="readonly")
+    image_combo.pack(side=tk.LEFT, padx=5)
 
-    image_frame = ttk.Frame(notebook, padding=10)
-    notebook.add(image_frame, text="图像映射")
+    def apply_image_column(event=None):
+        for layer_name in image_tree.selection():
+            image_states[layer_name]["column"] = image_column_var.get()
+            refresh_image_row(layer_name)
 
-    ttk.Label(image_frame, text="请选择PSD图像图层与Excel列(包含图像文件名)的映射关系:").pack(pady=5)
+    def load_image_editor(event=None):
+        selection = image_tree.selection()
+        if selection:
+            image_column_var.set(image_states[selection[0]]["column"])
 
-    image_canvas = tk.Canvas(image_frame, borderwidth=0)
-    image_scrollbar = ttk.Scrollbar(image_frame, orient="vertical", command=image_canvas.yview)
-    image_scrollable_frame = ttk.Frame(image_canvas)
+    image_combo.bind("<<ComboboxSelected>>", apply_image_column)
+    image_tree.bind("<<TreeviewSelect>>", load_image_editor)
 
-    image_scrollable_frame.bind(
-        "<Configure>",
-        lambda e: image_canvas.configure(scrollregion=image_canvas.bbox("all"))
-    )
+    ttk.Label(image_frame, text="注意: Excel中对应列应包含图像文件名(相对于数据文件夹的路径)").pack(pady=5)
 
-    image_canvas.create_window((0, 0), window=image_scrollable_frame, anchor="nw")
-    image_canvas.configure(yscrollcommand=image_scrollbar.set)
+    def auto_match():
+        for layer_name, column in auto_match_columns(text_states.keys(), excel_columns).items():
+            text_states[layer_name]["column"] = column
+            refresh_text_row(layer_name)
+        for layer_name, column in auto_match_columns(image_states.keys(), excel_columns).items():
+            image_states[layer_name]["column"] = column
+            refresh_image_row(layer_name)
+        load_editor()
+        load_image_editor()
+
+    ttk.Button(top_frame, text="按名称自动匹配", command=auto_match).pack(side=tk.RIGHT)
+    auto_match()
+
+    if preview:
+        ttk.Spinbox(preview_row_frame, from_=1, to=max(1, len(preview["df"])), textvariable=preview_row_var,
+                    width=8).pack(side=tk.LEFT, padx=2)
+        preview_row_var.trace_add("write", lambda *args: schedule_preview())
+        preview_result = {}
+
+        def build_preview():
+            # 编译和缩小模板较慢, 放到后台线程, 窗口先显示出来
+            try:
+                renderer = PreviewRenderer(preview["psd"], text_layers, image_layers, preview["folder_path"],
+                                           preview["text_strategy"], cancel=preview_state["cancel"])
+                if not renderer.cancelled:
+                    preview_result["renderer"] = renderer
+            except Exception as e:
+                preview_result["error"] = str(e)
 
-    image_canvas.pack(side="left", fill="both", expand=True, pady=5)
-    image_scrollbar.pack(side="right", fill="y")
+        preview_thread = threading.Thread(target=build_preview, daemon=True)
+        preview_state["thread"] = preview_thread
+        preview_thread.start()
 
-    image_comboboxes = []
-    for i, layer in enumerate(image_layers):
-        row_frame = ttk.Frame(image_scrollable_frame)
-        row_frame.pack(fill=tk.X, pady=3)
-        layer_name = layer['name']
-        layer_label = ttk.Label(row_frame, text=layer_name, width=15)
-        layer_label.pack(side=tk.LEFT, padx=5)
-        combo = ttk.Combobox(row_frame, values=["不替换"] + excel_columns, width=25)
-        combo.pack(side=tk.RIGHT, padx=5)
-        combo.current(0)
-        image_comboboxes.append((layer_name, combo))
+        def wait_preview():
+            if preview_thread.is_alive():
+                preview_state["job"] = dialog.after(100, wait_preview)
+                return
+            preview_state["job"] = None
+            if "error" in preview_result:
+                preview_label.config(text=f"无法生成预览: {preview_result['error']}")
+                return
+            preview_state["renderer"] = preview_result.get("renderer")
+            schedule_preview()
 
-    ttk.Label(image_frame, text="注意: Excel中对应列应包含图像文件名(相对于数据文件夹的路径)").pack(pady=5)
+        preview_state["job"] = dialog.after(100, wait_preview)
 
     button_frame = ttk.Frame(dialog)
     button_frame.pack(pady=10)
 
     def confirm():
-        for layer_name, combo in text_comboboxes:
-            selected = combo.get()
-            if selected != "不替换":
-                mapping_result["text_mapping"][layer_name] = selected
-        for layer_name, font_var in font_entries:
-            font_path = font_var.get()
-            if font_path != "保持原始字体":
-                mapping_result["font_mapping"][layer_name] = font_path
-        for layer_name, size_var in font_size_entries:
+        for layer_name, state in text_states.items():
+            if state["column"] != "不替换":
+                mapping_result["text_mapping"][layer_name] = state["column"]
+            if state["font"] != "保持原始字体":
+                mapping_result["font_mapping"][layer_name] = state["font"]
             try:
-                font_size = int(size_var.get())
-                mapping_result["font_size_mapping"][layer_name] = font_size
+                mapping_result["font_size_mapping"][layer_name] = int(state["size"])
             except (ValueError, TypeError):
                 pass
-        for layer_name, combo in image_comboboxes:
-            selected = combo.get()
-            if selected != "不替换":
-                mapping_result["image_mapping"][layer_name] = selected
+            if state["color_changed"]:
+                mapping_result["color_mapping"][layer_name] = state["color"]
+            mapping_result["align_mapping"][layer_name] = state["align"]
+        for layer_name, state in image_states.items():
+            if state["column"] != "不替换":
+                mapping_result["image_mapping"][layer_name] = state["column"]
 
         # 显示已选择的映射关系
         print("已确认的文本映射关系:")
@@ -347,12 +520,16 @@ def create_mapping_ui(text_layers, image_layers, excel_columns, parent_window):
             print(f"图层 '{layer_name}' 使用对齐方式 '{align}'")
 
         mapping_result["confirmed"] = True
+        stop_preview()
         dialog.destroy()
 
     def cancel():
         mapping_result["confirmed"] = False
+        stop_preview()
         dialog.destroy()
 
+    dialog.protocol("WM_DELETE_WINDOW", cancel)
+
     ttk.Button(button_frame, text="确认", command=confirm).pack(side=tk.LEFT, padx=5)
     ttk.Button(button_frame, text="取消", command=cancel).pack(side=tk.LEFT, padx=5)
 
@@ -445,7 +622,102 @@ def extract_all_layers_info(psd):
     return text_layers, image_layers
 
 
-def render_text_with_wrapping(draw, text, rect, font, text_color, align="left", v_align="center", text_strategy="auto"):
+class GlyphAtlas:
+    """按 (字体, 字号) 缓存光栅化后的字形蒙版
+
+    大量短文本(价格、名称)反复使用同一小字符集, 每个字形只经过 FreeType 光栅化一次,
+    之后按缓存的字宽和字距把字形蒙版逐个贴到画布上组成整行。
+    """
+
+    def __init__(self, max_glyphs=20000):
+        self.max_glyphs = max_glyphs
+        self.glyphs = {}
+        self.advances = {}
+        self.kerning = {}
+
+    def supports(self, font):
+        # RAQM 排版会做连字和上下文字形替换, 逐字拼接无法复现, 只接管 BASIC 排版的字体;
+        # 预检的溢出测量同样经过 measure_text, 也会回退到 draw.textlength
+        return (isinstance(font, ImageFont.FreeTypeFont) and isinstance(getattr(font, 'path', None), str)
+                and font.layout_engine == ImageFont.Layout.BASIC)
+
+    def font_key(self, font):
+        return (font.path, getattr(font, 'index', 0), font.size)
+
+    def clear(self):
+        self.glyphs.clear()
+        self.advances.clear()
+        self.kerning.clear()
+
+    def get_glyph(self, font, key, char):
+        glyph = self.glyphs.get((key, char))
+        if glyph is None:
+            if len(self.glyphs) >= self.max_glyphs:
+                self.glyphs.clear()
+            left, top, right, bottom = font.getbbox(char)
+            mask = None
+            if right > left and bottom > top:
+                mask = Image.new("L", (right - left, bottom - top), 0)
+                ImageDraw.Draw(mask).text((-left, -top), char, font=font, fill=255)
+            glyph = (mask, left, top)
+            self.glyphs[(key, char)] = glyph
+        return glyph
+
+    def get_advance(self, font, key, char):
+        advance = self.advances.get((key, char))
+        if advance is None:
+            advance = font.getlength(char)
+            self.advances[(key, char)] = advance
+        return advance
+
+    def get_kerning(self, font, key, previous, char):
+        pair = (key, previous, char)
+        kerning = self.kerning.get(pair)
+        if kerning is None:
+            kerning = font.getlength(previous + char) - self.get_advance(font, key, previous) - self.get_advance(font, key, char)
+            self.kerning[pair] = kerning
+        return kerning
+
+    def textlength(self, text, font):
+        key = self.font_key(font)
+        length = 0
+        previous = None
+        for char in text:
+            if previous is not None:
+                length += self.get_kerning(font, key, previous, char)
+            length += self.get_advance(font, key, char)
+            previous = char
+        return length
+
+    def draw_text(self, draw, xy, text, font, fill):
+        key = self.font_key(font)
+        # 与 draw.text 一致: 整数部分作为起点, 小数部分按 1/64 像素累加到笔位中再取整
+        base_x, base_y = int(xy[0]), int(xy[1])
+        pen_x = math.floor((xy[0] - base_x) * 64 + 0.5) / 64
+        # FreeType 的 y 轴向上, 恰好半像素时不进位
+        offset_y = 1 if math.floor((xy[1] - base_y) * 64 + 0.5) > 32 else 0
+        previous = None
+        for char in text:
+            if previous is not None:
+                pen_x += self.get_kerning(font, key, previous, char)
+            mask, left, top = self.get_glyph(font, key, char)
+            if mask is not None:
+                draw.bitmap((base_x + math.floor(pen_x + 0.5) + left, base_y + offset_y + top), mask, fill=fill)
+            pen_x += self.get_advance(font, key, char)
+            previous = char
+
+
+def measure_text(draw, text, font, glyph_atlas=None):
+    if glyph_atlas is not None and glyph_atlas.supports(font):
+        return glyph_atlas.textlength(text, font)
+    return draw.textlength(text, font=font)
+
+
+def layout_text(draw, text, rect, font, text_strategy="auto", glyph_atlas=None):
+    """只做排版(换行、自动缩小字号、截断), 不光栅化
+
+    返回 (最终字体, 行列表, 行高, 是否溢出被截断)。传入 glyph_atlas 时用缓存的字宽测量。
+    """
     left, top, right, bottom = rect
     width = right - left
     height = bottom - top
@@ -480,7 +752,7 @@ def render_text_with_wrapping(draw, text, rect, font, text_color, align="left",
             if current_font_size != original_font_size:
                 try:
                     if hasattr(font, 'path'):
-                        final_font = ImageFont.truetype(font.path, current_font_size)
+                        final_font = load_truetype(font.path, current_font_size)
                     else:
                         final_font = font
                         break
@@ -491,7 +763,7 @@ def render_text_with_wrapping(draw, text, rect, font, text_color, align="left",
             line = ""
             line_width = 0
             for word in words:
-                word_width = draw.textlength(word, font=final_font)
+                word_width = measure_text(draw, word, final_font, glyph_atlas)
                 if line_width + word_width <= width:
                     line += word
                     line_width += word_width
@@ -513,7 +785,7 @@ def render_text_with_wrapping(draw, text, rect, font, text_color, align="left",
         line = ""
         line_width = 0
         for word in words:
-            word_width = draw.textlength(word, font=font)
+            word_width = measure_text(draw, word, font, glyph_atlas)
             if line_width + word_width <= width:
                 line += word
                 line_width += word_width
@@ -529,7 +801,8 @@ def render_text_with_wrapping(draw, text, rect, font, text_color, align="left",
 
     line_height = final_font.size * 1.2 if hasattr(final_font, 'size') else 15
     max_lines = max(1, int(height / line_height))
-    if len(final_lines) > max_lines:
+    overflow = len(final_lines) > max_lines
+    if overflow:
         if max_lines > 1:
             final_lines = final_lines[:max_lines-1]
             if len(final_lines[-1]) > 10:
@@ -542,6 +815,16 @@ def render_text_with_wrapping(draw, text, rect, font, text_color, align="left",
             else:
                 final_lines = [final_lines[0]]
 
+    return final_font, final_lines, line_height, overflow
+
+
+def render_text_with_wrapping(draw, text, rect, font, text_color, align="left", v_align="center", text_strategy="auto",
+                              glyph_atlas=None):
+    left, top, right, bottom = rect
+    width = right - left
+    height = bottom - top
+    final_font, final_lines, line_height, overflow = layout_text(draw, text, rect, font, text_strategy, glyph_atlas)
+
     text_height = len(final_lines) * line_height
     if v_align == "center":
         y = top + (height - text_height) / 2
@@ -551,18 +834,127 @@ def render_text_with_wrapping(draw, text, rect, font, text_color, align="left",
         y = top
 
     for line in final_lines:
-        line_width = draw.textlength(line, font=final_font)
+        line_width = measure_text(draw, line, final_font, glyph_atlas)
         if align == "center":
             x = left + (width - line_width) / 2
         elif align == "right":
             x = right - line_width
         else:
             x = left
-        draw.text((x, y), line, font=final_font, fill=text_color)
+        if glyph_atlas is not None and glyph_atlas.supports(final_font):
+            glyph_atlas.draw_text(draw, (x, y), line, final_font, text_color)
+        else:
+            draw.text((x, y), line, font=final_font, fill=text_color)
         y += line_height
+    return overflow
+
+
+@functools.lru_cache(maxsize=256)
+def load_truetype(font_path, font_size):
+    return ImageFont.truetype(font_path, font_size)
+
+
+def try_load_truetype(font_path, font_size):
+    try:
+        return load_truetype(font_path, font_size)
+    except Exception:
+        return None
+
+
+def resolve_text_style(layer_name, layer_info, font_mapping, color_mapping, font_size_mapping):
+    """确定文本图层使用的字体、字号和颜色
+
+    font_source 记录字体来源: mapping(映射指定)、psd(按PSD字体名匹配)、system(系统中文字体)、
+    default(全部失败, 退回 Pillow 默认字体)。
+    """
+    font_size = 12
+    text_color = (0, 0, 0, 255)
+    font_name = None
+
+    if layer_info:
+        if layer_name in color_mapping:
+            text_color = color_mapping[layer_name]
+        elif layer_info['color']:
+            text_color = layer_info['color']
+        if layer_name in font_size_mapping:
+            font_size = font_size_mapping[layer_name]
+        elif layer_info['font_size']:
+            font_size = int(layer_info['font_size'])
+        if layer_info['font']:
+            font_name = layer_info['font']
+            if isinstance(font_name, dict) and 'Name' in font_name:
+                font_name = font_name['Name']
+
+    font = None
+    font_loaded = False
+    font_source = "default"
+
+    if layer_name in font_mapping:
+        font_path = font_mapping[layer_name]
+        if os.path.exists(font_path) and font_path != "保持原始字体":
+            font = try_load_truetype(font_path, font_size)
+            if font is not None:
+                font_loaded = True
+                font_source = "mapping"
+    if not font_loaded and isinstance(font_name, str):
+        font_filename_map = get_font_filename_map()
+        font_name_lower = font_name.lower().replace(" ", "")
+        mapped_font = None
+        for key, value in font_filename_map.items():
+            key_lower = key.lower().replace(" ", "")
+            if key_lower in font_name_lower or font_name_lower in key_lower:
+                mapped_font = value
+                break
+        if mapped_font and platform.system() == "Windows":
+            font = try_load_truetype(f"C:\\Windows\\Fonts\\{mapped_font}", font_size)
+            if font is not None:
+                font_loaded = True
+                font_source = "psd"
+    if not font_loaded:
+        system_fonts = []
+        if platform.system() == "Windows":
+            system_fonts = [
+                r"C:\Windows\Fonts\msyh.ttc",
+                r"C:\Windows\Fonts\simsun.ttc",
+                r"C:\Windows\Fonts\simhei.ttf",
+                r"C:\Windows\Fonts\simkai.ttf"
+            ]
+        elif platform.system() == "Darwin":
+            system_fonts = [
+                "/System/Library/Fonts/PingFang.ttc",
+                "/Library/Fonts/Arial Unicode.ttf",
+                "/System/Library/Fonts/STHeiti Light.ttc"
+            ]
+        elif platform.system() == "Linux":
+            system_fonts = [
+                "/usr/share/fonts/truetype/droid/DroidSansFallbackFull.ttf",
+                "/usr/share/fonts/truetype/wqy/wqy-microhei.ttc"
+            ]
+        local_fonts = [
+            "fonts/SimHei.ttf", 
+            "fonts/SimSun.ttf",
+            "fonts/msyh.ttc",
+            "SimHei.ttf", 
+            "SimSun.ttf"
+        ]
+        for font_path in system_fonts + local_fonts:
+            font = try_load_truetype(font_path, font_size)
+            if font is not None:
+                font_loaded = True
+                font_source = "system"
+                break
+    if not font_loaded:
+        font = ImageFont.load_default()
+    return {"font": font, "font_size": font_size, "text_color": text_color, "font_source": font_source}
+
+
+class QuietLog:
+    """丢弃所有日志, 供回归测试等不需要输出进度的调用方代替 log_text 使用"""
 
 
 def safe_update_log(log_text, message):
+    if isinstance(log_text, QuietLog):
+        return
     if log_text:
         log_text.after(0, lambda: log_text.configure(state="normal"))
         log_text.after(0, lambda: log_text.insert("end", message + "\n"))
@@ -592,7 +984,1348 @@ def list_available_fonts():
     return found_fonts
 
 
-def process_custom_psd(excel_file, folder_path, custom_psd_path, output_dir=None, log_text=None, parent_window=None, debug=False, text_strategy="auto"):
+OUTPUT_FORMATS = {
+    "png": "逐个PNG文件",
+    "zip": "ZIP分卷",
+    "tar": "TAR分卷",
+    "pdf": "多页PDF",
+    "tiff": "多页TIFF"
+}
+
+
+def flatten_to_rgb(image, background=(255, 255, 255)):
+    if image.mode == "RGB":
+        return image
+    if image.mode != "RGBA":
+        image = image.convert("RGBA")
+    flat = Image.new("RGB", image.size, background)
+    flat.paste(image, (0, 0), image)
+    return flat
+
+
+IMAGE_FORMAT_EXTENSIONS = {
+    "PNG": "png",
+    "JPEG": "jpg",
+    "WEBP": "webp"
+}
+
+
+def prepare_for_format(image, image_format="PNG"):
+    if image_format == "JPEG":
+        return flatten_to_rgb(image)
+    return image
+
+
+def encode_image(image, image_format="PNG"):
+    buffer = io.BytesIO()
+    prepare_for_format(image, image_format).save(buffer, image_format)
+    return buffer.getvalue()
+
+
+class ImageDirectorySink:
+    """每条记录保存为一个 {index+1}.png 等单独文件(默认输出方式)"""
+
+    def __init__(self, output_dir, image_format="PNG"):
+        self.output_dir = output_dir
+        self.image_format = image_format
+        self.extension = IMAGE_FORMAT_EXTENSIONS.get(image_format, image_format.lower())
+
+    def write(self, index, image):
+        output_filename = os.path.join(self.output_dir, f"{index + 1}.{self.extension}")
+        prepare_for_format(image, self.image_format).save(output_filename, self.image_format)
+
+    def write_encoded(self, index, data):
+        with open(os.path.join(self.output_dir, f"{index + 1}.{self.extension}"), "wb") as f:
+            f.write(data)
+
+    def close(self):
+        pass
+
+
+class ArchiveShardSink:
+    """把输出图片流式写入固定行数的 ZIP/TAR 分卷, 并在 index.csv 中记录每行所在分卷及数据偏移"""
+
+    def __init__(self, output_dir, archive_format="zip", shard_size=1000, image_format="PNG", file_prefix=""):
+        self.output_dir = output_dir
+        self.file_prefix = file_prefix
+        self.archive_format = archive_format
+        self.shard_size = max(1, int(shard_size))
+        self.image_format = image_format
+        self.extension = IMAGE_FORMAT_EXTENSIONS.get(image_format, image_format.lower())
+        self.shard_number = -1
+        self.shard_name = None
+        self.rows_in_shard = 0
+        self.archive = None
+        self.index_file = open(os.path.join(output_dir, f"{file_prefix}index.csv"), "w", newline="", encoding="utf-8")
+        self.index_writer = csv.writer(self.index_file)
+        self.index_writer.writerow(["row", "shard", "member", "offset", "size"])
+
+    def _close_archive(self):
+        if self.archive is not None:
+            self.archive.close()
+            self.archive = None
+
+    def _next_shard(self):
+        self._close_archive()
+        self.shard_number += 1
+        self.rows_in_shard = 0
+        self.shard_name = f"{self.file_prefix}shard_{self.shard_number:05d}.{self.archive_format}"
+        shard_path = os.path.join(self.output_dir, self.shard_name)
+        if self.archive_format == "zip":
+            # PNG/JPEG 本身已压缩, 直接存储即可, 也便于按偏移量随机读取
+            self.archive = zipfile.ZipFile(shard_path, "w", zipfile.ZIP_STORED, allowZip64=True)
+        else:
+            self.archive = tarfile.open(shard_path, "w")
+
+    def write(self, index, image):
+        self.write_encoded(index, encode_image(image, self.image_format))
+
+    def write_encoded(self, index, data):
+        if self.archive is None or self.rows_in_shard >= self.shard_size:
+            self._next_shard()
+        member = f"{index + 1}.{self.extension}"
+        if self.archive_format == "zip":
+            info = zipfile.ZipInfo(member, date_time=time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_STORED
+            self.archive.writestr(info, data)
+            offset = self.archive.fp.tell() - len(data)
+        else:
+            info = tarfile.TarInfo(member)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            self.archive.addfile(info, io.BytesIO(data))
+            # addfile 写入的是 info 的副本, 偏移由写完后的位置减去按 512 字节补齐的数据长度得到
+            offset = self.archive.offset - (len(data) + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE * tarfile.BLOCKSIZE
+        self.rows_in_shard += 1
+        self.index_writer.writerow([index + 1, self.shard_name, member, offset, len(data)])
+
+    def close(self):
+        self._close_archive()
+        self.index_file.close()
+
+
+def verify_shard_index(output_dir, file_prefix="", per_shard=False):
+    """按 index.csv 中记录的分卷、偏移和长度读回数据, 返回无法识别为图片的行号列表
+
+    默认逐行读回(回归测试使用); per_shard=True 时每个分卷只抽查最后一行(偏移计算有误时通常最后一行也读不出),
+    正式运行用它代替全量读回, 不会让输出的读取量翻倍。
+    """
+    failed_rows = []
+    with open(os.path.join(output_dir, f"{file_prefix}index.csv"), newline="", encoding="utf-8") as index_file:
+        records = list(csv.DictReader(index_file))
+    if per_shard:
+        records = list({record["shard"]: record for record in records}.values())
+    for record in records:
+        with open(os.path.join(output_dir, record["shard"]), "rb") as shard:
+            shard.seek(int(record["offset"]))
+            data = shard.read(int(record["size"]))
+        try:
+            Image.open(io.BytesIO(data))
+        except Exception:
+            failed_rows.append(int(record["row"]))
+    return failed_rows
+
+
+class StreamingPdfWriter:
+    """逐页写入 PDF
+
+    每页的 JPEG 图像和内容流写完即落盘, 关闭时再写页面树、目录和交叉引用表;
+    不会像 save(append=True) 那样每页重新解析整个文件, 耗时和文件大小都与页数成线性关系。
+    """
+
+    def __init__(self, path, resolution=72.0):
+        self.file = open(path, "wb")
+        self.resolution = resolution
+        self.offsets = {}
+        self.page_numbers = []
+        # 1 号对象为目录, 2 号对象为页面树, 都在关闭时写出
+        self.next_number = 3
+        self.file.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def _write_object(self, body, stream=None, number=None):
+        if number is None:
+            number = self.next_number
+            self.next_number += 1
+        self.offsets[number] = self.file.tell()
+        self.file.write(f"{number} 0 obj\n".encode("ascii") + body)
+        if stream is not None:
+            self.file.write(b"\nstream\n" + stream + b"\nendstream")
+        self.file.write(b"\nendobj\n")
+        return number
+
+    def add_page(self, image):
+        self.add_jpeg_page(encode_image(image, "JPEG"), image.size)
+
+    def add_jpeg_page(self, data, size):
+        """直接嵌入已编码的 JPEG, 渲染线程或子进程编码好的页面不用在写出时重新编码"""
+        width, height = size
+        image_number = self._write_object(
+            f"<< /Type /XObject /Subtype /Image /Width {width} /Height {height} /ColorSpace /DeviceRGB "
+            f"/BitsPerComponent 8 /Filter /DCTDecode /Length {len(data)} >>".encode("ascii"), data)
+        page_width = width * 72.0 / self.resolution
+        page_height = height * 72.0 / self.resolution
+        content = f"q {page_width:.4f} 0 0 {page_height:.4f} 0 0 cm /image Do Q".encode("ascii")
+        content_number = self._write_object(f"<< /Length {len(content)} >>".encode("ascii"), content)
+        page_number = self._write_object(
+            f"<< /Type /Page /Parent 2 0 R /Resources << /XObject << /image {image_number} 0 R >> >> "
+            f"/MediaBox [0 0 {page_width:.4f} {page_height:.4f}] /Contents {content_number} 0 R >>".encode("ascii"))
+        self.page_numbers.append(page_number)
+
+    def close(self):
+        kids = " ".join(f"{number} 0 R" for number in self.page_numbers)
+        self._write_object(f"<< /Type /Pages /Kids [{kids}] /Count {len(self.page_numbers)} >>".encode("ascii"),
+                           number=2)
+        self._write_object(b"<< /Type /Catalog /Pages 2 0 R >>", number=1)
+        xref_offset = self.file.tell()
+        self.file.write(f"xref\n0 {self.next_number}\n0000000000 65535 f \n".encode("ascii"))
+        for number in range(1, self.next_number):
+            self.file.write(f"{self.offsets[number]:010d} 00000 n \n".encode("ascii"))
+        self.file.write(f"trailer\n<< /Size {self.next_number} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n"
+                        .encode("ascii"))
+        self.file.close()
+
+
+class MultiPageSink:
+    """把所有输出逐页追加到一个多页 PDF 或 TIFF 文件中(用于打印)"""
+
+    def __init__(self, output_dir, page_format="pdf", file_prefix=""):
+        self.page_format = page_format
+        # PDF 页面在渲染任务中编码为 JPEG 后直接嵌入; TIFF 只能在追加时压缩, 子进程以无损 PNG 传回页面
+        self.image_format = "JPEG" if page_format == "pdf" else "PNG"
+        self.path = os.path.join(output_dir, f"{file_prefix}output.{page_format}")
+        self.page_count = 0
+        self.pdf_writer = StreamingPdfWriter(self.path) if page_format == "pdf" else None
+        self.tiff_writer = None
+        self.index_file = open(os.path.join(output_dir, f"{file_prefix}index.csv"), "w", newline="", encoding="utf-8")
+        self.index_writer = csv.writer(self.index_file)
+        self.index_writer.writerow(["row", "file", "page"])
+
+    def write(self, index, image):
+        if self.pdf_writer is not None:
+            self.pdf_writer.add_page(image)
+        else:
+            if self.tiff_writer is None:
+                self.tiff_writer = TiffImagePlugin.AppendingTiffWriter(self.path, True)
+            image.save(self.tiff_writer, 'TIFF', compression="tiff_deflate")
+            self.tiff_writer.newFrame()
+        self.index_writer.writerow([index + 1, os.path.basename(self.path), self.page_count + 1])
+        self.page_count += 1
+
+    def write_encoded(self, index, data):
+        if self.pdf_writer is None:
+            self.write(index, Image.open(io.BytesIO(data)))
+            return
+        self.pdf_writer.add_jpeg_page(data, Image.open(io.BytesIO(data)).size)
+        self.index_writer.writerow([index + 1, os.path.basename(self.path), self.page_count + 1])
+        self.page_count += 1
+
+    def close(self):
+        if self.pdf_writer is not None:
+            self.pdf_writer.close()
+            self.pdf_writer = None
+        if self.tiff_writer is not None:
+            self.tiff_writer.close()
+            self.tiff_writer = None
+        self.index_file.close()
+
+
+def create_output_sink(output_dir, output_format="png", shard_size=1000, image_format="PNG", file_prefix=""):
+    """file_prefix 只用于分卷和多页文件, 部分重跑时避免覆盖完整运行生成的文件; 逐个图片文件始终按行号命名"""
+    if output_format in ("zip", "tar"):
+        return ArchiveShardSink(output_dir, output_format, shard_size, image_format, file_prefix)
+    if output_format in ("pdf", "tiff"):
+        return MultiPageSink(output_dir, output_format, file_prefix)
+    return ImageDirectorySink(output_dir, image_format)
+
+
+def parse_output_sizes(text):
+    """解析附加输出尺寸, 例如 "web:50%:JPEG, thumb:256:JPEG, card:600x400:PNG"
+
+    尺寸可以是百分比、最长边像素或 宽x高 的限定框, 格式省略时为 PNG。
+    附加尺寸只能缩小(百分比不超过 100%), 名称用作子目录名, 不能重复。
+    """
+    output_sizes = []
+    names = set()
+    for item in text.replace("，", ",").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        parts = [p.strip() for p in item.split(":")]
+        if len(parts) < 2:
+            raise ValueError(f"无法解析输出尺寸: {item}")
+        name, size = parts[0], parts[1].lower()
+        if not name:
+            raise ValueError(f"输出尺寸缺少名称: {item}")
+        if name in names:
+            raise ValueError(f"输出尺寸名称重复: {name}")
+        names.add(name)
+        image_format = parts[2].upper() if len(parts) > 2 and parts[2] else "PNG"
+        if image_format == "JPG":
+            image_format = "JPEG"
+        if image_format not in IMAGE_FORMAT_EXTENSIONS:
+            raise ValueError(f"不支持的输出格式: {image_format}")
+        spec = {"name": name, "format": image_format}
+        if size.endswith("%"):
+            spec["scale"] = float(size[:-1]) / 100
+            if not 0 < spec["scale"] <= 1:
+                raise ValueError(f"百分比必须在 0-100% 之间: {item}")
+        elif "x" in size:
+            width, height = size.split("x", 1)
+            spec["max_size"] = (int(width), int(height))
+        else:
+            spec["max_size"] = (int(size), int(size))
+        if min(spec.get("max_size", (1, 1))) <= 0:
+            raise ValueError(f"尺寸必须大于 0: {item}")
+        output_sizes.append(spec)
+    return output_sizes
+
+
+def get_output_size(image_size, spec):
+    width, height = image_size
+    if "scale" in spec:
+        # 附加尺寸从成品图缩小得到, 不放大
+        ratio = min(spec["scale"], 1.0)
+    else:
+        max_width, max_height = spec["max_size"]
+        ratio = min(max_width / width, max_height / height, 1.0)
+    return max(1, round(width * ratio)), max(1, round(height * ratio))
+
+
+def build_output_pyramid(image, output_sizes):
+    """从同一张内存中的成品图依次缩小得到各个尺寸
+
+    按面积从大到小处理, 每个尺寸都从已生成的最小且足够大的层级缩小,
+    resize 的 reducing_gap 会先用 reduce 做整数倍快速缩小, 再做精确重采样。
+    """
+    levels = [image]
+    results = {}
+    targets = [(spec, get_output_size(image.size, spec)) for spec in output_sizes]
+    for spec, size in sorted(targets, key=lambda t: t[1][0] * t[1][1], reverse=True):
+        source = min(
+            (level for level in levels if level.width >= size[0] and level.height >= size[1]),
+            key=lambda level: level.width * level.height
+        )
+        if source.size == size:
+            resized = source
+        else:
+            resized = source.resize(size, Image.LANCZOS, reducing_gap=2.0)
+            levels.append(resized)
+        results[spec["name"]] = resized
+    return [(spec, results[spec["name"]]) for spec in output_sizes]
+
+
+def index_folder_files(folder_path):
+    """用 os.scandir 一次性索引数据文件夹下所有文件的相对路径"""
+    indexed = set()
+    pending = [folder_path]
+    while pending:
+        current = pending.pop()
+        try:
+            with os.scandir(current) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(entry.path)
+                    elif entry.is_file():
+                        indexed.add(normalize_relative_path(os.path.relpath(entry.path, folder_path)))
+        except OSError:
+            continue
+    return indexed
+
+
+def normalize_relative_path(path):
+    return os.path.normcase(os.path.normpath(path.strip()))
+
+
+def preflight_check(df, folder_path, text_layers, image_layers, mapping, text_strategy="auto"):
+    """渲染前快速检查整个数据集: 缺失的图片、无法加载的字体、会被截断的文本
+
+    每个字体只解析一次, 每个不同的文本值只做一次排版(不光栅化), 字宽取自 GlyphAtlas 的缓存。
+    """
+    report = {"missing_columns": [], "missing_images": [], "font_fallbacks": [], "overflow_rows": []}
+    text_mapping = mapping.get("text_mapping", {})
+    image_mapping = mapping.get("image_mapping", {})
+    font_mapping = mapping.get("font_mapping", {})
+    color_mapping = mapping.get("color_mapping", {})
+    font_size_mapping = mapping.get("font_size_mapping", {})
+
+    for layer_name, excel_column in list(text_mapping.items()) + list(image_mapping.items()):
+        if excel_column not in df.columns:
+            report["missing_columns"].append((layer_name, excel_column))
+
+    if image_mapping:
+        indexed_files = index_folder_files(folder_path)
+        for layer_name, excel_column in image_mapping.items():
+            if excel_column not in df.columns:
+                continue
+            values = df[excel_column].astype(str)
+            missing_values = set()
+            for value in values.unique():
+                if os.path.isabs(value.strip()):
+                    found = os.path.exists(value.strip())
+                else:
+                    found = normalize_relative_path(value) in indexed_files
+                if not found:
+                    missing_values.add(value)
+            if missing_values:
+                for index, value in values[values.isin(missing_values)].items():
+                    report["missing_images"].append((index, layer_name, value.strip()))
+
+    measure_draw = ImageDraw.Draw(Image.new("L", (1, 1)))
+    glyph_atlas = GlyphAtlas()
+    for layer_name, excel_column in text_mapping.items():
+        if excel_column not in df.columns:
+            continue
+        layer_info = next((l for l in text_layers if l['name'] == layer_name), None)
+        if layer_info is None:
+            continue
+        style = resolve_text_style(layer_name, layer_info, font_mapping, color_mapping, font_size_mapping)
+        if style["font_source"] == "default" or (layer_name in font_mapping and style["font_source"] != "mapping"):
+            report["font_fallbacks"].append((layer_name, font_mapping.get(layer_name, layer_info['font']), style["font_source"]))
+        left, top, right, bottom = layer_info['position']
+        rect = (0, 0, right - left, bottom - top)
+        values = df[excel_column].astype(str)
+        overflow_values = set()
+        for value in values.unique():
+            if layout_text(measure_draw, value, rect, style["font"], text_strategy, glyph_atlas)[3]:
+                overflow_values.add(value)
+        if overflow_values:
+            for index, value in values[values.isin(overflow_values)].items():
+                report["overflow_rows"].append((index, layer_name, value))
+    return report
+
+
+def write_preflight_report(report, report_path):
+    with open(report_path, "w", newline="", encoding="utf-8-sig") as f:
+        writer = csv.writer(f)
+        writer.writerow(["类型", "行", "图层", "值", "说明"])
+        for layer_name, excel_column in report["missing_columns"]:
+            writer.writerow(["缺少列", "", layer_name, excel_column, "Excel中不存在该列"])
+        for index, layer_name, filename in report["missing_images"]:
+            writer.writerow(["图片缺失", index + 1, layer_name, filename, "图片文件未找到"])
+        for layer_name, font, font_source in report["font_fallbacks"]:
+            writer.writerow(["字体回退", "", layer_name, font, f"实际使用: {font_source}"])
+        for index, layer_name, value in report["overflow_rows"]:
+            writer.writerow(["文本溢出", index + 1, layer_name, value, "文本将被截断"])
+
+
+COMPOSITORS = {
+    "pillow": "Pillow paste(默认, 忽略图层不透明度)",
+    "pillow_over": "Pillow alpha_composite",
+    "numpy": "NumPy预乘Alpha"
+}
+
+
+def blend_normal_premultiplied(canvas, layer, position, opacity=255, opaque=False):
+    """Photoshop 正常模式: 预乘 Alpha 下 out = src * opacity + dst * (1 - src_alpha * opacity)
+
+    canvas 和 layer 都是预乘 Alpha 的 uint8 数组, 只在图层与画布相交的区域内原地计算;
+    中间值用 uint16 保存, 255 * 255 + 128 不会溢出。完全不透明的图层直接复制。
+    """
+    left, top = position
+    height, width = layer.shape[:2]
+    x0, y0 = max(left, 0), max(top, 0)
+    x1, y1 = min(left + width, canvas.shape[1]), min(top + height, canvas.shape[0])
+    if x0 >= x1 or y0 >= y1:
+        return
+    src = layer[y0 - top:y1 - top, x0 - left:x1 - left]
+    dst = canvas[y0:y1, x0:x1]
+    if opaque and opacity >= 255:
+        dst[...] = src
+        return
+    src = src.astype(np.uint16)
+    if opacity < 255:
+        src *= opacity
+        div255(src)
+    blended = dst * (255 - src[..., 3:])
+    div255(blended)
+    blended += src
+    dst[...] = blended
+
+
+def div255(values):
+    """原地把 uint16 数组除以 255 并四舍五入, 用移位代替除法, 对 0..65025 精确"""
+    values += 128
+    values += values >> 8
+    values >>= 8
+    return values
+
+
+def premultiply(image):
+    return np.asarray(image.convert("RGBa"))
+
+
+def premultiply_layer(image):
+    """裁掉全透明的边缘后转换为预乘 Alpha 数组
+
+    返回 (数组, 裁剪偏移, 是否完全不透明), 图层全透明时返回 None。
+    文本图层大部分是透明像素, 裁剪后参与混合的像素通常只剩一小部分。
+    """
+    alpha = image.getchannel("A")
+    bbox = alpha.getbbox()
+    if bbox is None:
+        return None
+    if bbox != (0, 0, image.width, image.height):
+        image = image.crop(bbox)
+        alpha = alpha.crop(bbox)
+    opaque = alpha.getextrema()[0] == 255
+    return (np.asarray(image) if opaque else premultiply(image)), bbox[:2], opaque
+
+
+def apply_opacity(image, opacity):
+    if opacity >= 255:
+        return image
+    image = image.copy()
+    image.putalpha(image.getchannel("A").point(lambda a: (a * opacity + 127) // 255))
+    return image
+
+
+class PremultipliedCanvas:
+    """numpy 合成用的画布
+
+    只保存所有图层覆盖范围(dirty_box)内的预乘 Alpha 数组, 整行的图层都在这块区域里混合,
+    最后一次性转换回 RGBA 并贴回背景; 范围外的背景像素不参与任何计算。
+    """
+
+    def __init__(self, template):
+        self.background = template["background"]
+        self.box = template["dirty_box"]
+        self.array = template["background_premultiplied"].copy()
+
+    def blend(self, premultiplied, position, opacity=255):
+        if premultiplied is None:
+            return
+        layer, (offset_x, offset_y), opaque = premultiplied
+        blend_normal_premultiplied(self.array, layer, (position[0] + offset_x - self.box[0],
+                                                       position[1] + offset_y - self.box[1]), opacity, opaque)
+
+    def to_image(self):
+        image = self.background.copy()
+        if self.array.size:
+            image.paste(Image.fromarray(self.array, "RGBa").convert("RGBA"), self.box[:2])
+        return image
+
+
+def create_canvas(template, compositor="pillow"):
+    if compositor == "numpy":
+        return PremultipliedCanvas(template)
+    return template["background"].copy()
+
+
+def composite_layer(canvas, image, position, opacity=255, compositor="pillow", entry=None):
+    """把图层按所选合成方式叠加到画布上
+
+    pillow 沿用 paste(image, box, image) 的行为(Alpha 通道也按遮罩混合, 不处理不透明度);
+    pillow_over 和 numpy 按 Photoshop 正常模式合成并应用图层不透明度, 两者结果在 ±1 以内一致。
+    numpy 的画布是 PremultipliedCanvas; 贴模板原图时传入 entry, 直接使用 prepare_numpy_template 预先转换好的数组。
+    4000x3000 画布实测(python regression.py --benchmark-composite): 只计渲染时 paste 6.7 行/秒, alpha_composite 5.3, numpy 2.9,
+    计入模板编译时 4.6 / 4.1 / 3.3;
+    Pillow 的混合是一次 C 循环, numpy 要多次遍历数组, 所以 numpy 只作为可选后端, 默认仍为 pillow。
+    """
+    left, top = position
+    if compositor == "numpy":
+        if entry is not None and "premultiplied" in entry:
+            premultiplied = None
+            if entry["premultiplied"] is not None:
+                premultiplied = (entry["premultiplied"], entry["premultiplied_offset"], entry["premultiplied_opaque"])
+        else:
+            premultiplied = premultiply_layer(image)
+        canvas.blend(premultiplied, position, opacity)
+    elif compositor == "pillow_over":
+        # alpha_composite 不接受负坐标, 先裁掉画布外的部分
+        image = apply_opacity(image, opacity)
+        if left < 0 or top < 0:
+            image = image.crop((max(-left, 0), max(-top, 0), image.width, image.height))
+            left, top = max(left, 0), max(top, 0)
+        if left < canvas.width and top < canvas.height:
+            canvas.alpha_composite(image, (left, top))
+    else:
+        canvas.paste(image, (left, top), image)
+
+
+def finish_canvas(canvas, compositor="pillow"):
+    if compositor == "numpy":
+        return canvas.to_image()
+    return canvas
+
+
+def prepare_numpy_template(template):
+    """为 numpy 合成预先计算所有图层的覆盖范围, 并把该范围内的背景和各图层原图转换成预乘 Alpha 数组"""
+    width, height = template["size"]
+    rects = [entry["rect"] for entry in template["layers"]]
+    # 回退用的原图尺寸不一定与 rect 一致, 按实际贴图范围计算
+    rects += [(entry["rect"][0], entry["rect"][1], entry["rect"][0] + entry["image"].width,
+               entry["rect"][1] + entry["image"].height) for entry in template["layers"] if entry["image"] is not None]
+    x0 = max(0, min((rect[0] for rect in rects), default=0))
+    y0 = max(0, min((rect[1] for rect in rects), default=0))
+    x1 = max(x0, min(width, max((rect[2] for rect in rects), default=0)))
+    y1 = max(y0, min(height, max((rect[3] for rect in rects), default=0)))
+    template["dirty_box"] = (x0, y0, x1, y1)
+    template["background_premultiplied"] = premultiply(template["background"].crop((x0, y0, x1, y1)))
+    for entry in template["layers"]:
+        if entry["image"] is not None:
+            premultiplied = premultiply_layer(entry["image"])
+            entry["premultiplied"], entry["premultiplied_offset"], entry["premultiplied_opaque"] = \
+                premultiplied if premultiplied is not None else (None, (0, 0), False)
+    return template
+
+
+def compile_template(psd, text_layers, mapping, compositor="pillow", cancel=None):
+    """预先解码PSD顶层图层, 每次运行只做一次
+
+    位于最底部的连续静态图层直接合成为背景; 其余图层按绘制顺序记录为
+    static(解码好的静态图层)、text/image(按行替换的动态图层, 附带解码好的原图用于出错时回退)。
+    文本图层的字体、字号和颜色也在这里解析一次。
+    cancel(threading.Event)在每个图层解码前检查, 被设置时放弃编译并返回 None。
+    """
+    text_mapping = mapping.get("text_mapping", {})
+    image_mapping = mapping.get("image_mapping", {})
+    font_mapping = mapping.get("font_mapping", {})
+    color_mapping = mapping.get("color_mapping", {})
+    font_size_mapping = mapping.get("font_size_mapping", {})
+
+    background = Image.new('RGBA', psd.size, (255, 255, 255, 0))
+    layers = []
+    for layer in psd:
+        if cancel is not None and cancel.is_set():
+            return None
+        left, top, right, bottom = layer.bbox
+        if layer.kind == 'type' and layer.name in text_mapping:
+            kind = "text"
+        elif hasattr(layer, 'has_pixels') and layer.has_pixels and layer.name in image_mapping:
+            kind = "image"
+        else:
+            kind = "static"
+        layer_image = layer.topil()
+        if layer_image is not None:
+            layer_image = layer_image.convert('RGBA')
+        if kind == "static":
+            if layer_image is None:
+                continue
+            if not layers:
+                composite_layer(background, layer_image, (left, top), layer.opacity,
+                                "pillow" if compositor == "pillow" else "pillow_over")
+                continue
+        entry = {"kind": kind, "name": layer.name, "rect": (left, top, right, bottom), "image": layer_image,
+                 "opacity": layer.opacity}
+        if kind == "text":
+            layer_info = next((l for l in text_layers if l['name'] == layer.name), None)
+            entry["style"] = resolve_text_style(layer.name, layer_info, font_mapping, color_mapping, font_size_mapping)
+        layers.append(entry)
+    template = {"size": psd.size, "background": background, "layers": layers}
+    if compositor == "numpy":
+        prepare_numpy_template(template)
+    return template
+
+
+def render_psd_row(template, row, index, context):
+    log_text = context["log_text"]
+    debug_sample = context.get("debug_sample")
+    debug_writer = context.get("debug_writer")
+    # errors 模式下每行都先收集调试信息, 行结束后只保留出错或溢出的行
+    collect_debug = debug_sample is not None and debug_writer is not None
+    sampled = collect_debug and debug_row_selected(debug_sample, index)
+    debug_panels = []
+    compositor = context.get("compositor", "pillow")
+    canvas = create_canvas(template, compositor)
+
+    for entry in template["layers"]:
+        left, top, right, bottom = entry["rect"]
+        layer_width = right - left
+        layer_height = bottom - top
+        layer_name = entry["name"]
+
+        if entry["kind"] == "text":
+            try:
+                if sampled:
+                    safe_update_log(log_text, f"处理文本图层: '{layer_name}'")
+                excel_column = context["text_mapping"][layer_name]
+                new_text = str(row[excel_column])
+
+                text_layer = Image.new("RGBA", (layer_width, layer_height), (255, 255, 255, 0))
+                draw = ImageDraw.Draw(text_layer)
+
+                style = entry["style"]
+                font = style["font"]
+                text_color = style["text_color"]
+
+                if isinstance(new_text, str):
+                    new_text = new_text.encode('utf-8', errors='replace').decode('utf-8')
+
+                align = "left"
+                v_align = "center"
+                if layer_name in context["align_mapping"]:
+                    align, v_align = context["align_mapping"][layer_name]
+
+                overflow = render_text_with_wrapping(
+                    draw,
+                    new_text,
+                    (0, 0, layer_width, layer_height),
+                    font,
+                    text_color,
+                    align,
+                    v_align,
+                    context["text_strategy"],
+                    glyph_atlas=context["glyph_atlas"]
+                )
+
+                if collect_debug:
+                    debug_panels.append({
+                        "layer": layer_name,
+                        "image": text_layer,
+                        "info": [
+                            f"字体: {context['font_mapping'].get(layer_name, '默认')}",
+                            f"大小: {font.size if hasattr(font, 'size') else '未知'}",
+                            f"颜色: {text_color}",
+                            f"对齐: {align}/{v_align}"
+                        ],
+                        "overflow": overflow,
+                        "error": None
+                    })
+
+                composite_layer(canvas, text_layer, (left, top), entry.get("opacity", 255), compositor)
+
+            except Exception as e:
+                error_detail = traceback.format_exc()
+                safe_update_log(log_text, f"处理文本图层 '{layer_name}' 时出错: {str(e)}")
+                if debug_sample is not None:
+                    safe_update_log(log_text, f"错误详情: {error_detail}")
+                if collect_debug:
+                    debug_panels.append({"layer": layer_name, "image": entry["image"], "info": [],
+                                         "overflow": False, "error": str(e)})
+                if entry["image"] is not None:
+                    composite_layer(canvas, entry["image"], (left, top), entry.get("opacity", 255), compositor, entry)
+
+        elif entry["kind"] == "image":
+            try:
+                excel_column = context["image_mapping"][layer_name]
+                image_filename = str(row[excel_column])
+                image_path = os.path.join(context["folder_path"], image_filename.strip())
+                if os.path.exists(image_path):
+                    new_image = Image.open(image_path).convert('RGBA')
+                    new_image_resized = new_image.resize((layer_width, layer_height), Image.LANCZOS)
+                    composite_layer(canvas, new_image_resized, (left, top), entry.get("opacity", 255), compositor)
+                    if sampled:
+                        safe_update_log(log_text, f"处理图像图层 '{layer_name}' - 使用图片: {image_path}")
+                        debug_panels.append({"layer": layer_name, "image": new_image_resized, "info": [image_filename],
+                                             "overflow": False, "error": None})
+                else:
+                    safe_update_log(log_text, f"警告: 图片文件未找到: {image_path}")
+                    if collect_debug:
+                        debug_panels.append({"layer": layer_name, "image": entry["image"], "info": [image_filename],
+                                             "overflow": False, "error": "图片文件未找到"})
+                    if entry["image"] is not None:
+                        composite_layer(canvas, entry["image"], (left, top), entry.get("opacity", 255), compositor, entry)
+            except Exception as e:
+                safe_update_log(log_text, f"处理图像图层 '{layer_name}' 时出错: {str(e)}")
+                if collect_debug:
+                    debug_panels.append({"layer": layer_name, "image": entry["image"], "info": [],
+                                         "overflow": False, "error": str(e)})
+                if entry["image"] is not None:
+                    composite_layer(canvas, entry["image"], (left, top), entry.get("opacity", 255), compositor, entry)
+        else:
+            composite_layer(canvas, entry["image"], (left, top), entry.get("opacity", 255), compositor, entry)
+
+    final_image = finish_canvas(canvas, compositor)
+    if debug_panels:
+        has_problem = any(panel["overflow"] or panel["error"] for panel in debug_panels)
+        if sampled or (debug_sample["mode"] == "errors" and has_problem):
+            debug_writer.submit(index, debug_panels)
+
+    return final_image
+
+
+PREVIEW_SIZE = 480
+
+
+class PreviewRenderer:
+    """映射窗口中的低分辨率预览
+
+    打开窗口时按 PREVIEW_SIZE 缩小一次背景和所有图层原图; 之后每次只重新渲染设置发生变化的图层
+    (文字按缩放后的字号直接在小尺寸上排版), 再把缓存的各图层贴到缩小的背景上。
+    text_states / image_states 与 create_mapping_ui 中每个图层的设置字典相同。
+    cancel(threading.Event)被设置时在下一个图层前停止准备, cancelled 为 True, 该对象不可再使用。
+    """
+
+    def __init__(self, psd, text_layers, image_layers, folder_path, text_strategy="auto", max_size=PREVIEW_SIZE,
+                 cancel=None):
+        # 所有文本和图像图层都当作动态图层编译, 未映射的图层贴原图, 与实际输出一致
+        mapping = {"text_mapping": {layer['name']: None for layer in text_layers},
+                   "image_mapping": {layer['name']: None for layer in image_layers}}
+        template = compile_template(psd, text_layers, mapping, cancel=cancel)
+        self.cancelled = template is None
+        if self.cancelled:
+            return
+        width, height = template["size"]
+        self.scale = min(1.0, max_size / max(width, height, 1))
+        self.folder_path = folder_path
+        self.text_strategy = text_strategy
+        self.layer_info = {layer['name']: layer for layer in text_layers}
+        self.background = self._resize(template["background"])
+        self.layers = []
+        for entry in template["layers"]:
+            if cancel is not None and cancel.is_set():
+                self.cancelled = True
+                return
+            left, top, right, bottom = [int(round(value * self.scale)) for value in entry["rect"]]
+            image = self._resize(entry["image"]) if entry["image"] is not None else None
+            self.layers.append({"kind": entry["kind"], "name": entry["name"], "rect": (left, top, right, bottom),
+                                "image": image})
+        self.rendered = {}
+        self.errors = {}
+
+    def _resize(self, image):
+        if self.scale >= 1.0:
+            return image
+        size = (max(1, int(round(image.width * self.scale))), max(1, int(round(image.height * self.scale))))
+        return image.resize(size, Image.LANCZOS)
+
+    def _render_text(self, entry, row, state):
+        column = state["column"]
+        if column == "不替换":
+            return entry["image"]
+        layer_name = entry["name"]
+        font_mapping = {layer_name: state["font"]} if state["font"] != "保持原始字体" else {}
+        color_mapping = {layer_name: state["color"]} if state["color_changed"] else {}
+        try:
+            font_size_mapping = {layer_name: int(state["size"])}
+        except (ValueError, TypeError):
+            font_size_mapping = {}
+        style = resolve_text_style(layer_name, self.layer_info.get(layer_name), font_mapping, color_mapping,
+                                   font_size_mapping)
+        font = style["font"]
+        try:
+            font = font.font_variant(size=max(1, int(round(style["font_size"] * self.scale))))
+        except Exception:
+            pass
+        left, top, right, bottom = entry["rect"]
+        text_layer = Image.new("RGBA", (max(1, right - left), max(1, bottom - top)), (255, 255, 255, 0))
+        draw = ImageDraw.Draw(text_layer)
+        align, v_align = state["align"]
+        render_text_with_wrapping(draw, str(row[column]), (0, 0, text_layer.width, text_layer.height), font,
+                                  style["text_color"], align, v_align, self.text_strategy)
+        return text_layer
+
+    def _render_image(self, entry, row, state):
+        column = state["column"]
+        if column == "不替换":
+            return entry["image"]
+        image_path = os.path.join(self.folder_path, str(row[column]).strip())
+        if not os.path.exists(image_path):
+            return entry["image"]
+        left, top, right, bottom = entry["rect"]
+        size = (max(1, right - left), max(1, bottom - top))
+        new_image = Image.open(image_path)
+        # JPEG 直接按目标尺寸解码, 大图也不用完整解码
+        new_image.draft("RGB", size)
+        return new_image.convert('RGBA').resize(size, Image.LANCZOS)
+
+    def update(self, row, text_states, image_states, dirty=None):
+        """重新渲染 dirty 中的图层(为 None 时全部重新渲染), 返回 (合成后的预览图, 错误信息列表)
+
+        渲染出错的图层显示原图, 错误信息保留到该图层下次渲染成功为止。
+        """
+        for entry in self.layers:
+            layer_name = entry["name"]
+            if entry["kind"] == "static" or (dirty is not None and layer_name not in dirty
+                                             and layer_name in self.rendered):
+                continue
+            try:
+                if entry["kind"] == "text":
+                    self.rendered[layer_name] = self._render_text(entry, row, text_states[layer_name])
+                else:
+                    self.rendered[layer_name] = self._render_image(entry, row, image_states[layer_name])
+                self.errors.pop(layer_name, None)
+            except Exception as e:
+                self.errors[layer_name] = f"图层 '{layer_name}': {e}"
+                self.rendered[layer_name] = entry["image"]
+        canvas = self.background.copy()
+        for entry in self.layers:
+            image = entry["image"] if entry["kind"] == "static" else self.rendered.get(entry["name"])
+            if image is not None:
+                canvas.paste(image, entry["rect"][:2], image)
+        return canvas, list(self.errors.values())
+
+
+def parse_row_numbers(text):
+    """解析 "1,5,10-20" 形式的行号列表(从1开始, 与输出文件名一致)"""
+    rows = set()
+    for part in text.replace("，", ",").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            first, last = part.split("-", 1)
+            rows.update(range(int(first), int(last) + 1))
+        else:
+            rows.add(int(part))
+    return rows
+
+
+def parse_debug_sample(text):
+    """解析调试采样方式: all(全部)、every:N(每N行)、rows:1,5,10-20(指定行)、errors(仅出错或溢出的行)"""
+    text = (text or "").strip().lower()
+    if not text or text == "all":
+        return {"mode": "all"}
+    if text == "errors":
+        return {"mode": "errors"}
+    if text.startswith("every:"):
+        return {"mode": "every", "step": max(1, int(text[len("every:"):]))}
+    if text.startswith("rows:"):
+        return {"mode": "rows", "rows": parse_row_numbers(text[len("rows:"):])}
+    raise ValueError(f"无法解析调试采样方式: {text}")
+
+
+def debug_row_selected(debug_sample, index):
+    mode = debug_sample["mode"]
+    if mode == "all":
+        return True
+    if mode == "every":
+        return index % debug_sample["step"] == 0
+    if mode == "rows":
+        return index + 1 in debug_sample["rows"]
+    return False
+
+
+def normalize_id_value(value):
+    """把Excel单元格转换为用于比较的ID字符串
+
+    有空单元格的整数列会被 pandas 读成浮点数, 1001 变成 1001.0, 这里还原为 "1001"。
+    """
+    if isinstance(value, float):
+        if math.isnan(value):
+            return ""
+        if value.is_integer():
+            return str(int(value))
+    return str(value).strip()
+
+
+def select_rows(df, row_ranges="", id_column="", ids="", filter_expression=""):
+    """在渲染前按行号范围、ID列表和筛选表达式选出要处理的记录, 多个条件同时满足才保留
+
+    行号从1开始, 与完整运行时的输出文件名一致; 保留原来的行索引, 部分重跑的输出与完整运行同名。
+    filter_expression 使用 pandas 表达式, 例如 `价格` > 100 and `类别` == "水果"。
+    """
+    mask = pd.Series(True, index=df.index)
+    if row_ranges and row_ranges.strip():
+        try:
+            rows = parse_row_numbers(row_ranges)
+        except ValueError:
+            raise ValueError(f"无法解析行号范围: {row_ranges}")
+        mask &= (df.index + 1).isin(rows)
+    if ids and ids.strip():
+        if id_column not in df.columns:
+            raise ValueError(f"Excel中不存在ID列: {id_column}")
+        id_values = {value.strip() for value in ids.replace("，", ",").replace("\n", ",").split(",") if value.strip()}
+        mask &= df[id_column].map(normalize_id_value).isin(id_values)
+    if filter_expression and filter_expression.strip():
+        try:
+            result = df.eval(filter_expression)
+        except Exception as e:
+            raise ValueError(f"筛选表达式有误: {e}")
+        if not isinstance(result, pd.Series) or result.dtype != bool:
+            raise ValueError(f"筛选表达式的结果必须是真/假: {filter_expression}")
+        mask &= result
+    return df[mask]
+
+
+class DebugWriter:
+    """在后台线程中汇总调试图像, 运行结束时输出联系表(contact sheet)和 debug_summary.csv
+
+    渲染线程只把调试信息放入队列, 不做任何文件写入; 队列有上限, 写入跟不上时才会阻塞。
+    """
+
+    def __init__(self, debug_dir, tile_size=(320, 180), columns=6, tiles_per_sheet=120):
+        self.debug_dir = debug_dir
+        self.tile_size = tile_size
+        self.columns = columns
+        self.tiles_per_sheet = tiles_per_sheet
+        self.tiles = []
+        self.sheet_count = 0
+        self.row_count = 0
+        self.font = ImageFont.load_default()
+        self.summary_file = open(os.path.join(debug_dir, "debug_summary.csv"), "w", newline="", encoding="utf-8-sig")
+        self.summary_writer = csv.writer(self.summary_file)
+        self.summary_writer.writerow(["行", "图层", "信息", "溢出", "错误"])
+        self.queue = queue.Queue(maxsize=256)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, index, panels):
+        self.queue.put((index, panels))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            index, panels = item
+            try:
+                self._add_row(index, panels)
+            except Exception:
+                print(traceback.format_exc())
+
+    def _add_row(self, index, panels):
+        self.row_count += 1
+        for panel in panels:
+            self.summary_writer.writerow([index + 1, panel["layer"], "; ".join(panel["info"]),
+                                          "是" if panel["overflow"] else "", panel["error"] or ""])
+            self.tiles.append(self._make_tile(index, panel))
+            if len(self.tiles) >= self.tiles_per_sheet:
+                self._flush_sheet()
+
+    def _make_tile(self, index, panel):
+        tile_width, tile_height = self.tile_size
+        if panel["error"]:
+            background = (255, 220, 220)
+        elif panel["overflow"]:
+            background = (255, 240, 200)
+        else:
+            background = (240, 240, 240)
+        tile = Image.new("RGB", self.tile_size, background)
+        if panel["image"] is not None:
+            preview = panel["image"].copy()
+            preview.thumbnail((tile_width - 10, tile_height - 70))
+            tile.paste(preview, (5, 5), preview if preview.mode == "RGBA" else None)
+        tile_draw = ImageDraw.Draw(tile)
+        lines = [f"第 {index + 1} 行  图层: {panel['layer']}"] + panel["info"][:3]
+        if panel["error"]:
+            lines.append(f"错误: {panel['error']}")
+        elif panel["overflow"]:
+            lines.append("文本溢出, 已截断")
+        y = tile_height - 62
+        for line in lines[:4]:
+            tile_draw.text((5, y), line, font=self.font, fill=(0, 0, 0))
+            y += 15
+        return tile
+
+    def _flush_sheet(self):
+        if not self.tiles:
+            return
+        tile_width, tile_height = self.tile_size
+        rows = (len(self.tiles) + self.columns - 1) // self.columns
+        sheet = Image.new("RGB", (tile_width * self.columns, tile_height * rows), (255, 255, 255))
+        for i, tile in enumerate(self.tiles):
+            sheet.paste(tile, ((i % self.columns) * tile_width, (i // self.columns) * tile_height))
+        self.sheet_count += 1
+        sheet.save(os.path.join(self.debug_dir, f"debug_contact_sheet_{self.sheet_count:03d}.png"), 'PNG')
+        self.tiles = []
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self._flush_sheet()
+        self.summary_file.close()
+
+
+def estimate_row_memory(template):
+    """估算渲染一条记录需要的内存(字节)
+
+    每条记录持有一张整幅 RGBA 画布, 编码或生成附加尺寸时还有一份同样大小的临时缓冲;
+    每个动态图层另有渲染缓冲和缩放前的原图。
+    """
+    width, height = template["size"]
+    row_bytes = width * height * 4 * 2
+    for entry in template["layers"]:
+        if entry["kind"] != "static":
+            left, top, right, bottom = entry["rect"]
+            row_bytes += (right - left) * (bottom - top) * 4 * 2
+    return row_bytes
+
+
+def get_process_rss(pid=None, private=False):
+    """进程的常驻内存(字节), 默认为当前进程, 无法获取时返回 None
+
+    private=True 时扣除与其他进程共享的页(共享内存模板、公共库), 用于累加子进程内存时避免重复计算。
+    """
+    statm = f"/proc/{pid or 'self'}/statm"
+    if os.path.exists("/proc/self/statm"):
+        try:
+            with open(statm) as f:
+                fields = f.read().split()
+        except OSError:
+            return None
+        pages = int(fields[1]) - (int(fields[2]) if private else 0)
+        return pages * os.sysconf("SC_PAGE_SIZE")
+    if platform.system() == "Windows":
+        import ctypes
+        from ctypes import wintypes
+
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [
+                ("cb", wintypes.DWORD),
+                ("PageFaultCount", wintypes.DWORD),
+                ("PeakWorkingSetSize", ctypes.c_size_t),
+                ("WorkingSetSize", ctypes.c_size_t),
+                ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                ("PagefileUsage", ctypes.c_size_t),
+                ("PeakPagefileUsage", ctypes.c_size_t)
+            ]
+
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        kernel32 = ctypes.windll.kernel32
+        if pid is None:
+            process = kernel32.GetCurrentProcess()
+        else:
+            # PROCESS_QUERY_LIMITED_INFORMATION | PROCESS_VM_READ
+            process = kernel32.OpenProcess(0x1000 | 0x0010, False, pid)
+            if not process:
+                return None
+        try:
+            if ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+                # Windows 下取不到共享页数, private 时用提交的私有内存代替
+                return counters.PagefileUsage if private else counters.WorkingSetSize
+            return None
+        finally:
+            if pid is not None:
+                kernel32.CloseHandle(process)
+    # 其他系统(如 macOS)只能取到只增不减的峰值 ru_maxrss, 不能用于监控, 调度器保持启动时估算的限制
+    return None
+
+
+# 多进程模式下每个渲染进程自身的固定开销(解释器、pandas/psd-tools 等模块、字体), 单位 MB
+PROCESS_WORKER_OVERHEAD_MB = 100
+
+
+class MemoryAwareScheduler:
+    """按内存预算决定线程(进程)数和同时处理的记录数
+
+    启动时根据模板尺寸估算每条记录的内存, 限制线程数和在途记录数;
+    运行中监控实际 RSS, 接近预算时清空缓存并降低并发, 内存回落后再逐步放宽。
+    多进程模式下每个进程另计固定开销, 运行中把各渲染进程的私有内存一并计入 RSS。
+    """
+
+    def __init__(self, template, workers=1, memory_budget_mb=None, caches=None, processes=False):
+        self.row_bytes = estimate_row_memory(template)
+        self.memory_budget = memory_budget_mb * 1024 * 1024 if memory_budget_mb else None
+        self.caches = [cache for cache in (caches or []) if cache is not None]
+        # 渲染进程启动时把自己的 pid 放进这个队列(见 init_render_worker), 创建进程池后设置
+        self.worker_pid_queue = None
+        self.worker_pids = set()
+        workers = max(1, int(workers))
+        # 每个线程一条正在渲染、一条等待写出
+        max_in_flight = workers * 2
+        if self.memory_budget:
+            available = self.memory_budget - (get_process_rss() or 0)
+            if processes:
+                # 渲染只发生在子进程里, 每个进程同一时刻只渲染一条, 主进程里排队的记录和编码结果很小;
+                # 模板放进共享内存后还要多占一份
+                available -= SharedTemplate.template_bytes(template)
+                per_worker = PROCESS_WORKER_OVERHEAD_MB * 1024 * 1024 + self.row_bytes
+                workers = max(1, min(workers, int(available // per_worker)))
+                max_in_flight = workers * 2
+            else:
+                max_in_flight = max(1, min(max_in_flight, int(available // self.row_bytes)))
+        self.max_in_flight = max_in_flight
+        self.workers = min(workers, max_in_flight)
+        self.limit = max_in_flight
+        self.throttle_count = 0
+
+    def total_rss(self):
+        rss = get_process_rss()
+        if rss is None or self.worker_pid_queue is None:
+            return rss
+        while True:
+            try:
+                self.worker_pids.add(self.worker_pid_queue.get_nowait())
+            except queue.Empty:
+                break
+        # 已退出的进程取不到内存, 按 0 计
+        for pid in self.worker_pids:
+            rss += get_process_rss(pid, private=True) or 0
+        return rss
+
+    def in_flight_limit(self):
+        if not self.memory_budget:
+            return self.limit
+        rss = self.total_rss()
+        if rss is None:
+            return self.limit
+        if rss > self.memory_budget * 0.9:
+            for cache in self.caches:
+                cache.clear()
+            gc.collect()
+            if self.limit > 1:
+                self.limit -= 1
+                self.throttle_count += 1
+        elif rss < self.memory_budget * 0.75 and self.limit < self.max_in_flight:
+            self.limit += 1
+        return self.limit
+
+
+class SharedTemplate:
+    """把预处理好的模板(背景和各图层像素)放进一块共享内存, 供多个渲染进程只读共用
+
+    descriptor 只包含共享内存名称、各图像的偏移和尺寸以及图层的其余信息, 可以直接传给子进程;
+    子进程用 attach_shared_template 映射同一块内存, 不再各自解码PSD或复制图层像素。
+    numpy 合成用的预乘 Alpha 数组(背景和 premultiplied)同样放在共享内存中。
+    """
+
+    def __init__(self, template):
+        self.shm = shared_memory.SharedMemory(create=True, size=max(1, self.template_bytes(template)))
+        self.offset = 0
+        layers = []
+        for entry in template["layers"]:
+            shared_entry = dict(entry)
+            shared_entry["image"] = self._place(entry["image"])
+            if "premultiplied" in entry:
+                shared_entry["premultiplied"] = self._place(entry["premultiplied"])
+            if "style" in entry:
+                # 从内存加载的字体(如 Pillow 默认字体)无法序列化, 子进程按路径重新加载
+                style = dict(entry["style"])
+                font_path = getattr(style["font"], "path", None)
+                style["font_path"] = font_path if isinstance(font_path, str) else None
+                style["font"] = None
+                shared_entry["style"] = style
+            layers.append(shared_entry)
+        self.descriptor = {
+            "shm_name": self.shm.name,
+            "size": template["size"],
+            "background": self._place(template["background"]),
+            "layers": layers
+        }
+        if "background_premultiplied" in template:
+            self.descriptor["background_premultiplied"] = self._place(template["background_premultiplied"])
+            self.descriptor["dirty_box"] = template["dirty_box"]
+
+    @classmethod
+    def template_bytes(cls, template):
+        """模板放入共享内存后占用的字节数"""
+        buffers = [template["background"], template.get("background_premultiplied")]
+        for entry in template["layers"]:
+            buffers += [entry["image"], entry.get("premultiplied")]
+        return sum(cls._buffer_size(value) for value in buffers if value is not None)
+
+    @staticmethod
+    def _buffer_size(value):
+        if isinstance(value, np.ndarray):
+            return value.nbytes
+        return value.size[0] * value.size[1] * 4
+
+    def _place(self, value):
+        if value is None:
+            return None
+        if isinstance(value, np.ndarray):
+            data = np.ascontiguousarray(value, dtype=np.uint8).tobytes()
+            ref = ("array", self.offset, value.shape)
+        else:
+            data = value.convert("RGBA").tobytes()
+            ref = ("image", self.offset, value.size)
+        self.shm.buf[self.offset:self.offset + len(data)] = data
+        self.offset += len(data)
+        return ref
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+def attach_shared_template(descriptor):
+    """在子进程中映射共享内存, 返回与 compile_template 结构相同的模板, 图层图像直接引用共享内存"""
+    # spawn 出的子进程与主进程共用同一个 resource_tracker, 共享内存仍由主进程的 SharedTemplate.close 释放
+    shm = shared_memory.SharedMemory(name=descriptor["shm_name"])
+
+    def view(ref):
+        if ref is None:
+            return None
+        kind, offset, shape = ref
+        if kind == "array":
+            array = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf, offset=offset)
+            array.flags.writeable = False
+            return array
+        length = shape[0] * shape[1] * 4
+        return Image.frombuffer("RGBA", shape, shm.buf[offset:offset + length], "raw", "RGBA", 0, 1)
+
+    layers = []
+    for shared_entry in descriptor["layers"]:
+        entry = dict(shared_entry)
+        entry["image"] = view(shared_entry["image"])
+        if "premultiplied" in shared_entry:
+            entry["premultiplied"] = view(shared_entry["premultiplied"])
+        if "style" in shared_entry:
+            style = dict(shared_entry["style"])
+            if style["font_path"]:
+                style["font"] = load_truetype(style["font_path"], style["font_size"])
+            else:
+                style["font"] = ImageFont.load_default()
+            entry["style"] = style
+        layers.append(entry)
+    template = {"size": descriptor["size"], "background": view(descriptor["background"]), "layers": layers, "shm": shm}
+    if "background_premultiplied" in descriptor:
+        template["background_premultiplied"] = view(descriptor["background_premultiplied"])
+        template["dirty_box"] = descriptor["dirty_box"]
+    return template
+
+
+class DebugPanelCollector:
+    """子进程中代替 DebugWriter, 收集调试图层后随结果一起交给主进程写出"""
+
+    def __init__(self):
+        self.panels = None
+
+    def submit(self, index, panels):
+        self.panels = panels
+
+
+_render_worker = {}
+
+
+def init_render_worker(descriptor, context, encode_plan, pid_queue=None):
+    if pid_queue is not None:
+        pid_queue.put(os.getpid())
+    _render_worker["template"] = attach_shared_template(descriptor)
+    _render_worker["context"] = dict(
+        context,
+        glyph_atlas=GlyphAtlas() if context.get("text_backend") == "atlas" else None,
+        debug_writer=DebugPanelCollector() if context.get("debug_sample") is not None else None,
+        # 界面日志控件不能传入子进程, 只有 QuietLog 会随 context 传过来
+        log_text=context.get("log_text")
+    )
+    _render_worker["encode_plan"] = encode_plan
+
+
+def encode_output(image, image_format):
+    # image_format 为 None 时(线程模式下的多页 TIFF)交回图像本身, 由输出端追加页面时压缩
+    return image if image_format is None else encode_image(image, image_format)
+
+
+def render_and_encode_row(template, row, index, context, encode_plan):
+    """渲染一条记录, 生成附加尺寸并按各输出的格式编码
+
+    编码和缩放都在渲染任务里完成, 多个线程或进程可以并行; 主线程写出时只需把数据落盘。
+    """
+    final_image = render_psd_row(template, row, index, context)
+    result = {"image": encode_output(final_image, encode_plan["image_format"]), "variants": {}, "debug_panels": None}
+    if encode_plan["output_sizes"]:
+        for spec, variant_image in build_output_pyramid(final_image, encode_plan["output_sizes"]):
+            result["variants"][spec["name"]] = encode_output(variant_image, encode_plan["variant_formats"][spec["name"]])
+    if isinstance(context["debug_writer"], DebugPanelCollector):
+        result["debug_panels"] = context["debug_writer"].panels
+        context["debug_writer"].panels = None
+    return result
+
+
+def render_row_in_worker(row, index):
+    """在子进程中渲染一条记录, 并按主进程各输出的格式编码, 只把编码后的数据传回"""
+    return render_and_encode_row(_render_worker["template"], row, index, _render_worker["context"],
+                                 _render_worker["encode_plan"])
+
+
+def create_process_executor(shared_template, workers, context, encode_plan, pid_queue=None):
+    """pid_queue 为 multiprocessing.get_context("spawn").Queue() 时, 每个子进程启动后放入自己的 pid"""
+    # 主线程运行 Tk, 统一用 spawn 启动子进程, 避免 fork 带走其他线程的状态
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                               initializer=init_render_worker,
+                               initargs=(shared_template.descriptor, context, encode_plan, pid_queue))
+
+
+def process_custom_psd(excel_file, folder_path, custom_psd_path, output_dir=None, log_text=None, parent_window=None, debug=False, text_strategy="auto",
+                       output_format="png", shard_size=1000, output_sizes=None, text_backend="pillow", preflight=False,
+                       workers=1, memory_budget_mb=None, debug_sample="all", worker_mode="thread", compositor="pillow",
+                       row_ranges="", id_column="", ids="", filter_expression=""):
     try:
         safe_update_log(log_text, "正在加载PSD文件...")
         try:
@@ -615,11 +2348,24 @@ def process_custom_psd(excel_file, folder_path, custom_psd_path, output_dir=None
         except Exception as e:
             return f"❌ 读取Excel文件失败: {e}"
 
+        full_row_count = len(df)
+        try:
+            df = select_rows(df, row_ranges, id_column, ids, filter_expression)
+        except ValueError as e:
+            return f"❌ {e}"
+        partial_run = len(df) < full_row_count
+        if partial_run:
+            safe_update_log(log_text, f"已选择 {len(df)}/{full_row_count} 条记录")
+            if len(df) == 0:
+                return "❌ 没有符合筛选条件的记录"
+
         safe_update_log(log_text, "请在弹出窗口中设置映射关系...")
         mapping_queue = queue.Queue()
 
         def show_mapping_dialog():
-            mapping = create_mapping_ui(text_layers, image_layers, excel_columns, parent_window)
+            mapping = create_mapping_ui(text_layers, image_layers, excel_columns, parent_window,
+                                        preview={"psd": psd, "df": df, "folder_path": folder_path,
+                                                 "text_strategy": text_strategy})
             mapping_queue.put(mapping)
 
         if parent_window:
@@ -631,8 +2377,6 @@ def process_custom_psd(excel_file, folder_path, custom_psd_path, output_dir=None
         text_mapping = mapping["text_mapping"]
         image_mapping = mapping["image_mapping"]
         font_mapping = mapping.get("font_mapping", {})
-        color_mapping = mapping.get("color_mapping", {})
-        font_size_mapping = mapping.get("font_size_mapping", {})
         align_mapping = mapping.get("align_mapping", {})
 
         if not text_mapping and not image_mapping:
@@ -644,187 +2388,158 @@ def process_custom_psd(excel_file, folder_path, custom_psd_path, output_dir=None
 
         debug_dir = None
         if debug:
+            try:
+                debug_sample = parse_debug_sample(debug_sample)
+            except ValueError as e:
+                return f"❌ {e}"
             debug_dir = os.path.join(output_dir, "debug")
             os.makedirs(debug_dir, exist_ok=True)
+        else:
+            debug_sample = None
+
+        if preflight:
+            safe_update_log(log_text, f"正在预检 {len(df)} 条记录...")
+            start_time = time.perf_counter()
+            report = preflight_check(df, folder_path, text_layers, image_layers, mapping, text_strategy)
+            report_path = os.path.join(output_dir, "preflight_report.csv")
+            write_preflight_report(report, report_path)
+            safe_update_log(log_text, f"预检耗时 {time.perf_counter() - start_time:.2f} 秒")
+            for layer_name, excel_column in report["missing_columns"]:
+                safe_update_log(log_text, f"缺少列: 图层 '{layer_name}' 对应的列 '{excel_column}' 不存在")
+            for layer_name, font, font_source in report["font_fallbacks"]:
+                safe_update_log(log_text, f"字体回退: 图层 '{layer_name}' 的字体 '{font}' 无法加载, 实际使用 {font_source}")
+            for index, layer_name, filename in report["missing_images"][:20]:
+                safe_update_log(log_text, f"图片缺失: 第 {index + 1} 行 图层 '{layer_name}': {filename}")
+            for index, layer_name, value in report["overflow_rows"][:20]:
+                safe_update_log(log_text, f"文本溢出: 第 {index + 1} 行 图层 '{layer_name}': {value}")
+            problem_count = sum(len(items) for items in report.values())
+            if problem_count == 0:
+                return "✅ 预检通过, 未发现问题"
+            return (f"⚠️ 预检发现 {len(report['missing_images'])} 处图片缺失、{len(report['overflow_rows'])} 处文本溢出、"
+                    f"{len(report['font_fallbacks'])} 个字体回退、{len(report['missing_columns'])} 个缺失列, 详见 {report_path}")
+
+        output_sizes = output_sizes or []
+        variant_sinks = {}
+        try:
+            file_prefix = "partial_" if partial_run else ""
+            sink = create_output_sink(output_dir, output_format, shard_size, file_prefix=file_prefix)
+            for spec in output_sizes:
+                variant_dir = os.path.join(output_dir, spec["name"])
+                os.makedirs(variant_dir, exist_ok=True)
+                variant_sinks[spec["name"]] = create_output_sink(variant_dir, output_format, shard_size, spec["format"],
+                                                                 file_prefix)
+        except Exception as e:
+            return f"❌ 无法创建输出文件: {e}"
 
-        safe_update_log(log_text, f"开始处理 {len(df)} 条记录...")
-        total_rows = len(df)
-        for index, row in df.iterrows():
-            safe_update_log(log_text, f"处理第 {index+1}/{total_rows} 条记录")
-            final_image = Image.new('RGBA', psd.size, (255, 255, 255, 0))
+        glyph_atlas = GlyphAtlas() if text_backend == "atlas" else None
 
-            for layer_index, layer in enumerate(psd):
-                left, top, right, bottom = layer.bbox
-                layer_width = right - left
-                layer_height = bottom - top
-
-                if layer.kind == 'type' and layer.name in text_mapping:
-                    try:
-                        if debug:
-                            safe_update_log(log_text, f"处理文本图层: '{layer.name}'")
-                        excel_column = text_mapping[layer.name]
-                        new_text = str(row[excel_column])
-                        layer_info = next((l for l in text_layers if l['name'] == layer.name), None)
-
-                        text_layer = Image.new("RGBA", (layer_width, layer_height), (255, 255, 255, 0))
-                        draw = ImageDraw.Draw(text_layer)
-
-                        font_size = 12
-                        text_color = (0, 0, 0, 255)
-                        font_name = None
-
-                        if layer_info:
-                            if layer.name in color_mapping:
-                                text_color = color_mapping[layer.name]
-                            elif layer_info['color']:
-                                text_color = layer_info['color']
-                            if layer.name in font_size_mapping:
-                                font_size = font_size_mapping[layer.name]
-                            elif layer_info['font_size']:
-                                font_size = int(layer_info['font_size'])
-                            if layer_info['font']:
-                                font_name = layer_info['font']
-                                if isinstance(font_name, dict) and 'Name' in font_name:
-                                    font_name = font_name['Name']
-
-                        font = None
-                        font_loaded = False
-
-                        if layer.name in font_mapping:
-                            font_path = font_mapping[layer.name]
-                            if os.path.exists(font_path) and font_path != "保持原始字体":
-                                try:
-                                    font = ImageFont.truetype(font_path, font_size)
-                                    font_loaded = True
-                                except Exception as e:
-                                    pass
-                        if not font_loaded and isinstance(font_name, str):
-                            font_filename_map = get_font_filename_map()
-                            font_name_lower = font_name.lower().replace(" ", "")
-                            mapped_font = None
-                            for key, value in font_filename_map.items():
-                                key_lower = key.lower().replace(" ", "")
-                                if key_lower in font_name_lower or font_name_lower in key_lower:
-                                    mapped_font = value
-                                    break
-                            if mapped_font and platform.system() == "Windows":
-                                try:
-                                    font_path = f"C:\\Windows\\Fonts\\{mapped_font}"
-                                    font = ImageFont.truetype(font_path, font_size)
-                                    font_loaded = True
-                                except Exception as e:
-                                    pass
-                        if not font_loaded:
-                            system_fonts = []
-                            if platform.system() == "Windows":
-                                system_fonts = [
-                                    r"C:\Windows\Fonts\msyh.ttc",
-                                    r"C:\Windows\Fonts\simsun.ttc",
-                                    r"C:\Windows\Fonts\simhei.ttf",
-                                    r"C:\Windows\Fonts\simkai.ttf"
-                                ]
-                            elif platform.system() == "Darwin":
-                                system_fonts = [
-                                    "/System/Library/Fonts/PingFang.ttc",
-                                    "/Library/Fonts/Arial Unicode.ttf",
-                                    "/System/Library/Fonts/STHeiti Light.ttc"
-                                ]
-                            elif platform.system() == "Linux":
-                                system_fonts = [
-                                    "/usr/share/fonts/truetype/droid/DroidSansFallbackFull.ttf",
-                                    "/usr/share/fonts/truetype/wqy/wqy-microhei.ttc"
-                                ]
-                            local_fonts = [
-                                "fonts/SimHei.ttf", 
-                                "fonts/SimSun.ttf",
-                                "fonts/msyh.ttc",
-                                "SimHei.ttf", 
-                                "SimSun.ttf"
-                            ]
-                            for font_path in system_fonts + local_fonts:
-                                try:
-                                    font = ImageFont.truetype(font_path, font_size)
-                                    font_loaded = True
-                                    break
-                                except:
-                                    continue
-                        if not font_loaded:
-                            font = ImageFont.load_default()
-
-                        if isinstance(new_text, str):
-                            new_text = new_text.encode('utf-8', errors='replace').decode('utf-8')
-
-                        align = "left"
-                        v_align = "center"
-                        if layer.name in align_mapping:
-                            align, v_align = align_mapping[layer.name]
-
-                        render_text_with_wrapping(
-                            draw,
-                            new_text,
-                            (0, 0, layer_width, layer_height),
-                            font,
-                            text_color,
-                            align,
-                            v_align,
-                            text_strategy
-                        )
-
-                        if debug and debug_dir:
-                            debug_img = Image.new('RGBA', (layer_width + 20, layer_height + 70), (240, 240, 240, 255))
-                            debug_img.paste(text_layer, (10, 10))
-                            debug_draw = ImageDraw.Draw(debug_img)
-                            debug_font = ImageFont.load_default()
-                            debug_info = [
-                                f"图层: {layer.name}",
-                                f"字体: {font_mapping.get(layer.name, '默认')}",
-                                f"大小: {font.size if hasattr(font, 'size') else '未知'}",
-                                f"颜色: {text_color}",
-                                f"对齐: {align}/{v_align}"
-                            ]
-                            y = layer_height + 15
-                            for info in debug_info:
-                                debug_draw.text((10, y), info, font=debug_font, fill=(0, 0, 0, 255))
-                                y += 15
-                            debug_img.save(os.path.join(debug_dir, f"debug_{index}_{layer.name}.png"), 'PNG')
-
-                        final_image.paste(text_layer, (left, top), text_layer)
-
-                    except Exception as e:
-                        error_detail = traceback.format_exc()
-                        safe_update_log(log_text, f"处理文本图层 '{layer.name}' 时出错: {str(e)}")
-                        if debug:
-                            safe_update_log(log_text, f"错误详情: {error_detail}")
-                        layer_image = layer.topil().convert('RGBA')
-                        final_image.paste(layer_image, (left, top), layer_image)
-
-                elif hasattr(layer, 'has_pixels') and layer.has_pixels and layer.name in image_mapping:
-                    try:
-                        excel_column = image_mapping[layer.name]
-                        image_filename = str(row[excel_column])
-                        image_path = os.path.join(folder_path, image_filename.strip())
-                        if os.path.exists(image_path):
-                            new_image = Image.open(image_path).convert('RGBA')
-                            new_image_resized = new_image.resize((layer_width, layer_height), Image.LANCZOS)
-                            final_image.paste(new_image_resized, (left, top), new_image_resized)
-                            if debug:
-                                safe_update_log(log_text, f"处理图像图层 '{layer.name}' - 使用图片: {image_path}")
-                        else:
-                            safe_update_log(log_text, f"警告: 图片文件未找到: {image_path}")
-                            layer_image = layer.topil().convert('RGBA')
-                            final_image.paste(layer_image, (left, top), layer_image)
-                    except Exception as e:
-                        safe_update_log(log_text, f"处理图像图层 '{layer.name}' 时出错: {str(e)}")
-                        layer_image = layer.topil().convert('RGBA')
-                        final_image.paste(layer_image, (left, top), layer_image)
-                else:
-                    layer_image = layer.topil().convert('RGBA')
-                    final_image.paste(layer_image, (left, top), layer_image)
-
-            output_filename = os.path.join(output_dir, f"{index + 1}.png")
-            final_image.save(output_filename, 'PNG')
-            if index % 5 == 0 or index == total_rows - 1:
-                safe_update_log(log_text, f"✅ 已完成: {index + 1}/{total_rows}")
+        safe_update_log(log_text, "正在预处理模板图层...")
+        template = compile_template(psd, text_layers, mapping, compositor)
+        total_rows = len(df)
+        context = {
+            "text_mapping": text_mapping,
+            "image_mapping": image_mapping,
+            "font_mapping": font_mapping,
+            "align_mapping": align_mapping,
+            "folder_path": folder_path,
+            "text_strategy": text_strategy,
+            "glyph_atlas": glyph_atlas,
+            "compositor": compositor,
+            "debug_sample": debug_sample,
+            "debug_writer": DebugWriter(debug_dir) if debug_dir else None,
+            "log_text": log_text
+        }
+        scheduler = MemoryAwareScheduler(template, workers, memory_budget_mb, caches=[glyph_atlas],
+                                         processes=worker_mode == "process")
+        use_processes = worker_mode == "process" and scheduler.workers > 1
+        safe_update_log(log_text, f"预计每条记录占用约 {scheduler.row_bytes / 1024 / 1024:.0f}MB 内存, "
+                                  f"使用 {scheduler.workers} 个{'进程' if use_processes else '线程'}, "
+                                  f"最多同时处理 {scheduler.max_in_flight} 条")
+
+        def encoded_format(output_sink):
+            # 多页 TIFF 不能逐页预先压缩, 线程模式下直接交回图像, 子进程则以 PNG 传回
+            if not use_processes and getattr(output_sink, "page_format", None) == "tiff":
+                return None
+            return output_sink.image_format
+
+        encode_plan = {
+            "image_format": encoded_format(sink),
+            "output_sizes": output_sizes,
+            "variant_formats": {name: encoded_format(variant_sink) for name, variant_sink in variant_sinks.items()}
+        }
+        def write_output(output_sink, index, data):
+            if isinstance(data, Image.Image):
+                output_sink.write(index, data)
+            else:
+                output_sink.write_encoded(index, data)
+
+        def finish_row(position, index, future):
+            result = future.result()
+            write_output(sink, index, result["image"])
+            for name, data in result["variants"].items():
+                write_output(variant_sinks[name], index, data)
+            if result["debug_panels"]:
+                context["debug_writer"].submit(index, result["debug_panels"])
+            # 进度按已处理的条数计算, 输出文件仍按原始行号命名
+            if position % 5 == 0 or position == total_rows - 1:
+                safe_update_log(log_text, f"✅ 已完成: {position + 1}/{total_rows}")
+
+        # 按提交顺序写出结果, 输出文件的顺序与单线程时一致
+        pending = collections.deque()
+        shared_template = None
+        try:
+            # 共享内存在 try 中创建, 启动进程池失败时也会在 finally 中释放
+            if use_processes:
+                safe_update_log(log_text, "正在把模板放入共享内存...")
+                shared_template = SharedTemplate(template)
+                worker_context = {key: value for key, value in context.items()
+                                  if key not in ("glyph_atlas", "debug_writer", "log_text")}
+                worker_context["text_backend"] = text_backend
+                # 渲染内存都在子进程里, 监控时把各子进程的私有内存一并计入
+                scheduler.worker_pid_queue = multiprocessing.get_context("spawn").Queue()
+                executor = create_process_executor(shared_template, scheduler.workers, worker_context, encode_plan,
+                                                   scheduler.worker_pid_queue)
+                # 主进程不再渲染, 释放自己的模板副本, 内存只随在途记录数增长
+                template = None
+                gc.collect()
+            else:
+                executor = ThreadPoolExecutor(max_workers=scheduler.workers)
+            safe_update_log(log_text, f"开始处理 {len(df)} 条记录...")
+            with executor:
+                for position, (index, row) in enumerate(df.iterrows()):
+                    while pending and len(pending) >= scheduler.in_flight_limit():
+                        finish_row(*pending.popleft())
+                    if partial_run:
+                        safe_update_log(log_text, f"处理第 {position+1}/{total_rows} 条记录 (第 {index+1} 行)")
+                    else:
+                        safe_update_log(log_text, f"处理第 {index+1}/{total_rows} 条记录")
+                    if shared_template is not None:
+                        future = executor.submit(render_row_in_worker, row, index)
+                    else:
+                        future = executor.submit(render_and_encode_row, template, row, index, context, encode_plan)
+                    pending.append((position, index, future))
+                while pending:
+                    finish_row(*pending.popleft())
+        finally:
+            if shared_template is not None:
+                shared_template.close()
+            sink.close()
+            for variant_sink in variant_sinks.values():
+                variant_sink.close()
+            if context["debug_writer"] is not None:
+                context["debug_writer"].close()
+                safe_update_log(log_text, f"调试信息已汇总到 {debug_dir}")
+            if scheduler.throttle_count:
+                safe_update_log(log_text, f"内存接近预算, 共降低并发 {scheduler.throttle_count} 次")
+
+        if output_format in ("zip", "tar"):
+            # 每个分卷抽查一行, 确认记录的偏移可以直接随机读取; 图片本身已经写入分卷, 抽查失败只给出警告
+            for check_dir in [output_dir] + [os.path.join(output_dir, spec["name"]) for spec in output_sizes]:
+                failed_rows = verify_shard_index(check_dir, file_prefix, per_shard=True)
+                if failed_rows:
+                    return (f"⚠️ 图片已生成，存放在 {output_dir}, 但 {check_dir} 的分卷索引抽查失败: "
+                            f"第 {failed_rows[:10]} 行无法按偏移读出, 不要依赖 index.csv 随机读取")
+            safe_update_log(log_text, "分卷索引抽查通过")
 
         return f"✅ 所有图片已生成，存放在 {output_dir}"
 
@@ -864,14 +2579,80 @@ def add_custom_psd_tab(notebook, parent_window):
     text_strategy_var = tk.StringVar(value="auto")
     ttk.Radiobutton(text_strategy_frame, text="自动调整文字大小", variable=text_strategy_var, value="auto").pack(side=tk.LEFT, padx=(0, 10))
     ttk.Radiobutton(text_strategy_frame, text="固定文字大小(可能截断)", variable=text_strategy_var, value="fixed").pack(side=tk.LEFT)
-
+    glyph_cache_var = tk.BooleanVar()
+    ttk.Checkbutton(text_strategy_frame, text="字形缓存加速", variable=glyph_cache_var).pack(side=tk.LEFT, padx=(10, 0))
+    ttk.Label(text_strategy_frame, text="图层合成:").pack(side=tk.LEFT, padx=(10, 2))
+    compositor_labels = {label: key for key, label in COMPOSITORS.items()}
+    compositor_var = tk.StringVar(value=COMPOSITORS["pillow"])
+    ttk.Combobox(text_strategy_frame, textvariable=compositor_var, values=list(COMPOSITORS.values()),
+                 state="readonly", width=28).pack(side=tk.LEFT)
+
+    ttk.Label(custom_frame, text="输出方式:").grid(column=0, row=3, sticky="w", pady=5)
+    output_frame = ttk.Frame(custom_frame)
+    output_frame.grid(column=1, row=3, sticky="w", pady=5)
+    output_format_labels = {label: key for key, label in OUTPUT_FORMATS.items()}
+    output_format_var = tk.StringVar(value=OUTPUT_FORMATS["png"])
+    ttk.Combobox(output_frame, textvariable=output_format_var, values=list(OUTPUT_FORMATS.values()),
+                 state="readonly", width=14).pack(side=tk.LEFT, padx=(0, 10))
+    ttk.Label(output_frame, text="每个分卷行数:").pack(side=tk.LEFT)
+    shard_size_var = tk.StringVar(value="1000")
+    ttk.Entry(output_frame, textvariable=shard_size_var, width=8).pack(side=tk.LEFT, padx=2)
+
+    ttk.Label(custom_frame, text="附加尺寸:").grid(column=0, row=4, sticky="w", pady=5)
+    output_sizes_var = tk.StringVar()
+    output_sizes_entry = ttk.Entry(custom_frame, width=40, textvariable=output_sizes_var)
+    output_sizes_entry.grid(column=1, row=4, sticky="w", pady=5)
+    ToolTip(output_sizes_entry, "名称:尺寸:格式, 多个用逗号分隔, 例如 web:50%:JPEG, thumb:256:JPEG")
+
+    ttk.Label(custom_frame, text="并行处理:").grid(column=0, row=5, sticky="w", pady=5)
+    performance_frame = ttk.Frame(custom_frame)
+    performance_frame.grid(column=1, row=5, sticky="w", pady=5)
+    ttk.Label(performance_frame, text="线程数:").pack(side=tk.LEFT)
+    workers_var = tk.StringVar(value="1")
+    ttk.Entry(performance_frame, textvariable=workers_var, width=5).pack(side=tk.LEFT, padx=(2, 10))
+    process_mode_var = tk.BooleanVar()
+    process_mode_check = ttk.Checkbutton(performance_frame, text="多进程", variable=process_mode_var)
+    process_mode_check.pack(side=tk.LEFT, padx=(0, 10))
+    ToolTip(process_mode_check, "每个线程改为独立进程, 模板通过共享内存共用")
+    ttk.Label(performance_frame, text="内存预算(MB, 留空不限制):").pack(side=tk.LEFT)
+    memory_budget_var = tk.StringVar()
+    ttk.Entry(performance_frame, textvariable=memory_budget_var, width=8).pack(side=tk.LEFT, padx=2)
+
+    ttk.Label(custom_frame, text="处理范围:").grid(column=0, row=6, sticky="w", pady=5)
+    selection_frame = ttk.Frame(custom_frame)
+    selection_frame.grid(column=1, row=6, columnspan=2, sticky="w", pady=5)
+    ttk.Label(selection_frame, text="行号:").pack(side=tk.LEFT)
+    row_ranges_var = tk.StringVar()
+    row_ranges_entry = ttk.Entry(selection_frame, textvariable=row_ranges_var, width=14)
+    row_ranges_entry.pack(side=tk.LEFT, padx=(2, 10))
+    ToolTip(row_ranges_entry, "从1开始, 例如 1,5,10000-10500; 留空处理全部")
+    ttk.Label(selection_frame, text="ID列:").pack(side=tk.LEFT)
+    id_column_var = tk.StringVar()
+    ttk.Entry(selection_frame, textvariable=id_column_var, width=8).pack(side=tk.LEFT, padx=2)
+    ids_var = tk.StringVar()
+    ids_entry = ttk.Entry(selection_frame, textvariable=ids_var, width=14)
+    ids_entry.pack(side=tk.LEFT, padx=(2, 10))
+    ToolTip(ids_entry, "要处理的ID, 用逗号分隔")
+    ttk.Label(selection_frame, text="筛选:").pack(side=tk.LEFT)
+    filter_expression_var = tk.StringVar()
+    filter_expression_entry = ttk.Entry(selection_frame, textvariable=filter_expression_var, width=20)
+    filter_expression_entry.pack(side=tk.LEFT, padx=2)
+    ToolTip(filter_expression_entry, "pandas 表达式, 例如 `价格` > 100 and `类别` == \"水果\"")
+
+    debug_frame = ttk.Frame(custom_frame)
+    debug_frame.grid(column=1, row=7, sticky="w", pady=5)
     debug_var = tk.BooleanVar()
-    debug_check = ttk.Checkbutton(custom_frame, text="启用调试模式（输出详细日志和调试图像）", variable=debug_var)
-    debug_check.grid(column=1, row=3, sticky="w", pady=5)
+    debug_check = ttk.Checkbutton(debug_frame, text="启用调试模式（输出详细日志和调试图像）", variable=debug_var)
+    debug_check.pack(side=tk.LEFT)
+    ttk.Label(debug_frame, text="采样:").pack(side=tk.LEFT, padx=(10, 2))
+    debug_sample_var = tk.StringVar(value="errors")
+    debug_sample_entry = ttk.Entry(debug_frame, textvariable=debug_sample_var, width=14)
+    debug_sample_entry.pack(side=tk.LEFT)
+    ToolTip(debug_sample_entry, "all: 全部行; every:N: 每N行; rows:1,5,10-20: 指定行; errors: 仅出错或文本溢出的行")
 
     log_frame = ttk.LabelFrame(custom_frame, text="处理日志")
-    log_frame.grid(column=0, row=5, columnspan=3, sticky="nsew", pady=10)
-    custom_frame.grid_rowconfigure(5, weight=1)
+    log_frame.grid(column=0, row=9, columnspan=3, sticky="nsew", pady=10)
+    custom_frame.grid_rowconfigure(9, weight=1)
     custom_frame.grid_columnconfigure(0, weight=0)
     custom_frame.grid_columnconfigure(1, weight=1)
     custom_frame.grid_columnconfigure(2, weight=0)
@@ -888,7 +2669,7 @@ def add_custom_psd_tab(notebook, parent_window):
         log_text.configure(state="disabled")
         log_text.see("end")
 
-    def start_process():
+    def start_process(preflight=False):
         psd_path = psd_path_var.get()
         folder_path = folder_path_var.get()
         if not psd_path or not os.path.exists(psd_path):
@@ -908,7 +2689,26 @@ def add_custom_psd_tab(notebook, parent_window):
         update_log(f"开始处理自定义PSD: {psd_path}")
         update_log(f"使用数据: {excel_file}")
         update_log(f"文本处理策略: {text_strategy_var.get()}")
+        output_format = output_format_labels.get(output_format_var.get(), "png")
+        try:
+            shard_size = int(shard_size_var.get())
+        except ValueError:
+            update_log("❌ 每个分卷行数必须是整数!")
+            return
+        update_log(f"输出方式: {OUTPUT_FORMATS[output_format]}")
+        try:
+            output_sizes = parse_output_sizes(output_sizes_var.get())
+        except ValueError as e:
+            update_log(f"❌ 附加尺寸设置有误: {e}")
+            return
+        try:
+            workers = int(workers_var.get())
+            memory_budget_mb = int(memory_budget_var.get()) if memory_budget_var.get().strip() else None
+        except ValueError:
+            update_log("❌ 线程数和内存预算必须是整数!")
+            return
         process_button.config(state="disabled")
+        preflight_button.config(state="disabled")
 
         def process_thread():
             try:
@@ -919,7 +2719,21 @@ def add_custom_psd_tab(notebook, parent_window):
                     log_text=log_text,
                     parent_window=parent_window,
                     debug=debug_var.get(),
-                    text_strategy=text_strategy_var.get()
+                    debug_sample=debug_sample_var.get(),
+                    text_strategy=text_strategy_var.get(),
+                    output_format=output_format,
+                    shard_size=shard_size,
+                    output_sizes=output_sizes,
+                    text_backend="atlas" if glyph_cache_var.get() else "pillow",
+                    preflight=preflight,
+                    workers=workers,
+                    memory_budget_mb=memory_budget_mb,
+                    worker_mode="process" if process_mode_var.get() else "thread",
+                    compositor=compositor_labels.get(compositor_var.get(), "pillow"),
+                    row_ranges=row_ranges_var.get(),
+                    id_column=id_column_var.get().strip(),
+                    ids=ids_var.get(),
+                    filter_expression=filter_expression_var.get()
                 )
                 custom_frame.after(0, lambda: update_log(result))
             except Exception as e:
@@ -928,16 +2742,22 @@ def add_custom_psd_tab(notebook, parent_window):
                 custom_frame.after(0, lambda: update_log(f"❌ 处理出错: {str(e)}"))
             finally:
                 custom_frame.after(0, lambda: process_button.config(state="normal"))
+                custom_frame.after(0, lambda: preflight_button.config(state="normal"))
 
         threading.Thread(target=process_thread, daemon=True).start()
 
-    process_button = ttk.Button(custom_frame, text="开始处理", command=start_process)
-    process_button.grid(column=1, row=4, pady=10)
+    button_frame = ttk.Frame(custom_frame)
+    button_frame.grid(column=1, row=8, pady=10)
+    preflight_button = ttk.Button(button_frame, text="预检", command=lambda: start_process(preflight=True))
+    preflight_button.pack(side=tk.LEFT, padx=5)
+    process_button = ttk.Button(button_frame, text="开始处理", command=start_process)
+    process_button.pack(side=tk.LEFT, padx=5)
 
     return custom_frame
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     root = tk.Tk()
     root.title("PSD自动处理工具")
     root.geometry("800x600")